@@ -0,0 +1,59 @@
+"""Measure PriorityAllocator build and allocation time against listener occupancy.
+
+Usage:
+    python -m benchmarks.allocation [--count N] [--repeat N]
+"""
+import argparse
+import random
+import time
+
+from src import index
+
+OCCUPANCY_LEVELS = (0.0, 0.01, 0.25, 0.5, 0.9, 0.99, 0.999)
+
+
+def build_occupancy(fraction, rng):
+    low, high = index.ALB_RULE_PRIORITY_RANGE
+    occupancy = bytearray(index.ALB_MAX_PRIORITY + 1)
+    for priority in rng.sample(range(low, high + 1), int((high - low + 1) * fraction)):
+        occupancy[priority] = 1
+    return occupancy
+
+
+def run(count, repeat, seed=0):
+    rng = random.Random(seed)
+    results = []
+    for fraction in OCCUPANCY_LEVELS:
+        occupancy = build_occupancy(fraction, rng)
+        free = index.PriorityAllocator(occupancy).free
+        allocated = min(count, free)
+        build_times, allocate_times = [], []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            allocator = index.PriorityAllocator(occupancy)
+            built = time.perf_counter()
+            allocator.allocate_many(allocated)
+            build_times.append(built - started)
+            allocate_times.append(time.perf_counter() - built)
+        results.append({
+            'occupancy': fraction,
+            'free': free,
+            'build_ms': min(build_times) * 1000,
+            'allocate_us_per_priority': min(allocate_times) * 1e6 / max(1, allocated),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=20, help='priorities allocated per run')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per occupancy level (best is reported)')
+    args = parser.parse_args()
+
+    print(f"{'occupancy':>10} {'free':>7} {'build ms':>9} {'alloc us/priority':>18}")
+    for result in run(args.count, args.repeat):
+        print(f"{result['occupancy']:>10.1%} {result['free']:>7} {result['build_ms']:>9.3f} {result['allocate_us_per_priority']:>18.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Stored benchmark baselines, so that a run slower than its baseline fails.
+
+Baselines live in baselines.json next to this module, grouped by benchmark name. A metric
+regresses when it exceeds its baseline by more than the tolerance factor. Only metrics that do
+not depend on the machine are checked by default: call counts, whether boto3 was imported, and
+ratios between timings taken in the same run. Absolute timings are only reported, unless
+--check-timings is given after the baselines were regenerated on the machine running the check.
+"""
+import json
+import os
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), 'baselines.json')
+DEFAULT_TOLERANCE = 2.0
+GATED_SUFFIXES = ('api_calls_per_request', 'boto3_imported', '_ratio')
+
+
+def add_arguments(parser):
+    parser.add_argument('--check', action='store_true', help='exit non-zero if a metric regresses against its baseline')
+    parser.add_argument('--update-baselines', action='store_true', help='store this run as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='allowed factor over the baseline (default %(default)s)')
+    parser.add_argument('--check-timings', action='store_true', help='also check absolute timings, for baselines recorded on this machine')
+
+
+def load():
+    if not os.path.exists(BASELINES_PATH):
+        return {}
+    with open(BASELINES_PATH) as f:
+        return json.load(f)
+
+
+def compare(benchmark, metrics, args):
+    """Check or store `metrics` for `benchmark` as requested by the command line, returning the exit code."""
+    stored = load()
+    if args.update_baselines:
+        stored[benchmark] = {name: round(value, 3) for name, value in sorted(metrics.items())}
+        with open(BASELINES_PATH, 'w') as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Updated {benchmark} baselines in {BASELINES_PATH}")
+        return 0
+    if not args.check:
+        return 0
+
+    regressions = []
+    for name, value in sorted(metrics.items()):
+        baseline = stored.get(benchmark, {}).get(name)
+        if baseline is None:
+            print(f"No baseline for {benchmark}.{name}")
+        elif value > baseline * args.tolerance:
+            regression = f"{benchmark}.{name}: {value:.3f} > {baseline:.3f} x {args.tolerance}"
+            if name.endswith(GATED_SUFFIXES) or args.check_timings:
+                regressions.append(regression)
+            else:
+                print(f"Slower than baseline (not checked, machine dependent) {regression}")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
@@ -0,0 +1,104 @@
+"""Measure cold-start import time and time to first response for each RequestType.
+
+Every sample runs in a fresh interpreter, importing src.index and handling one event against
+local stand-ins for ELBv2 and the CloudFormation response URL.
+
+Usage:
+    python -m benchmarks.cold_start [--samples N] [--check] [--update-baselines]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from benchmarks import baselines
+from benchmarks.servers import AWS_ENVIRONMENT, FakeElbv2Server, ResponseServer
+
+LISTENER_ARN = 'arn:aws:elasticloadbalancing:us-east-1:123456789012:listener/app/bench/0123456789abcdef/0123456789abcdef'
+REQUEST_TYPES = ('Create', 'Update', 'Delete', 'Invalid')
+
+CHILD = '''
+import json, sys, time
+started = time.perf_counter()
+from src import index
+imported = time.perf_counter()
+
+class Context:
+    log_stream_name = "cold-start-benchmark"
+    def get_remaining_time_in_millis(self):
+        return 30000
+
+event = json.loads(sys.argv[1])
+try:
+    index.handler(event, Context())
+except Exception:
+    pass
+responded = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "first_response_ms": (responded - imported) * 1000,
+    "boto3_imported": "boto3" in sys.modules,
+}))
+'''
+
+
+def make_event(request_type, response_url):
+    event = {
+        'RequestType': 'Create' if request_type == 'Invalid' else request_type,
+        'ResponseURL': response_url,
+        'StackId': 'arn:aws:cloudformation:us-east-1:123456789012:stack/bench/0',
+        'RequestId': 'cold-start',
+        'LogicalResourceId': 'ListenerRuleAllocation',
+        'ResourceProperties': {'ListenerArn': LISTENER_ARN, 'PriorityCount': '2'},
+    }
+    if request_type == 'Update':
+        event['PhysicalResourceId'] = 'cold-start'
+        event['OldResourceProperties'] = dict(event['ResourceProperties'])
+    if request_type == 'Delete':
+        event['PhysicalResourceId'] = 'cold-start'
+    if request_type == 'Invalid':
+        del event['ResourceProperties']['ListenerArn']
+    return event
+
+
+def run(samples):
+    results = {}
+    with FakeElbv2Server({LISTENER_ARN: [10, 20, 30]}) as elbv2, ResponseServer() as responses:
+        env = dict(os.environ, **AWS_ENVIRONMENT, AWS_ENDPOINT_URL_ELASTIC_LOAD_BALANCING_V2=elbv2.url, PYTHONDONTWRITEBYTECODE='1')
+        for request_type in REQUEST_TYPES:
+            event = json.dumps(make_event(request_type, responses.response_url))
+            expected = 'FAILED' if request_type == 'Invalid' else 'SUCCESS'
+            runs = []
+            for _ in range(samples):
+                output = subprocess.run([sys.executable, '-c', CHILD, event], env=env, capture_output=True, text=True, check=True)
+                runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+                status = responses.responses[-1]['Status']
+                if status != expected:
+                    raise RuntimeError(f"{request_type} responded {status}, expected {expected}: {responses.responses[-1]['Reason']}")
+            results[request_type] = {
+                'import_ms': statistics.median(r['import_ms'] for r in runs),
+                'first_response_ms': statistics.median(r['first_response_ms'] for r in runs),
+                'boto3_imported': runs[0]['boto3_imported'],
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=5, help='fresh interpreters per RequestType (median is reported)')
+    baselines.add_arguments(parser)
+    args = parser.parse_args()
+
+    results = run(args.samples)
+    print(f"{'request':>8} {'import ms':>10} {'first response ms':>18} {'boto3 imported':>15}")
+    for request_type, result in results.items():
+        print(f"{request_type:>8} {result['import_ms']:>10.1f} {result['first_response_ms']:>18.1f} {str(result['boto3_imported']):>15}")
+
+    metrics = {f'{request_type}.{name}': float(value) for request_type, result in results.items() for name, value in result.items()}
+    return baselines.compare('cold_start', metrics, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""Local stand-ins for the AWS endpoints the function talks to.
+
+FakeElbv2Server speaks the ELBv2 query protocol closely enough for botocore to parse its
+DescribeRules responses, so the real client (credential and endpoint resolution, parsing,
+retries) is exercised against it by pointing AWS_ENDPOINT_URL_ELASTIC_LOAD_BALANCING_V2 at `server.url`.
+ResponseServer accepts the custom resource response PUTs.
+"""
+import json
+import random
+import socket
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape
+
+XMLNS = 'http://elasticloadbalancing.amazonaws.com/doc/2015-12-01/'
+AWS_ENVIRONMENT = {
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_SESSION_TOKEN': 'testing',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately; without this, delayed ACKs add ~40 ms per call
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload, content_type='text/xml'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class _Elbv2Handler(_Handler):
+    def do_POST(self):
+        params = {k: v[0] for k, v in parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode()).items()}
+        action = params.get('Action')
+        self.server.count(action)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.should_throttle():
+            self.server.count('Throttled')
+            return self._error(400, 'Throttling', 'Rate exceeded')
+        if action != 'DescribeRules':
+            return self._error(400, 'InvalidAction', f'{action} is not supported by the fake')
+
+        listener_arn = params['ListenerArn']
+        if listener_arn not in self.server.listeners:
+            return self._error(400, 'ListenerNotFound', f'Listener {listener_arn} not found')
+
+        rules = ['default'] + [str(p) for p in self.server.listeners[listener_arn]]
+        start = int(params.get('Marker', 0))
+        page_size = int(params.get('PageSize', 400))
+        page = rules[start:start + page_size]
+        members = ''.join(
+            f'<member><RuleArn>{escape(listener_arn)}/rule/{i}</RuleArn><Priority>{priority}</Priority>'
+            f'<IsDefault>{str(priority == "default").lower()}</IsDefault></member>'
+            for i, priority in enumerate(page, start)
+        )
+        marker = f'<NextMarker>{start + page_size}</NextMarker>' if start + page_size < len(rules) else ''
+        self._reply(200, (
+            f'<DescribeRulesResponse xmlns="{XMLNS}"><DescribeRulesResult><Rules>{members}</Rules>{marker}</DescribeRulesResult>'
+            f'<ResponseMetadata><RequestId>fake</RequestId></ResponseMetadata></DescribeRulesResponse>'
+        ).encode())
+
+    def _error(self, status, code, message):
+        self._reply(status, (
+            f'<ErrorResponse xmlns="{XMLNS}"><Error><Type>Sender</Type><Code>{code}</Code><Message>{escape(message)}</Message></Error>'
+            f'<RequestId>fake</RequestId></ErrorResponse>'
+        ).encode())
+
+
+class _ResponseHandler(_Handler):
+    def do_PUT(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.count('PUT')
+        with self.server.lock:
+            self.server.responses.append(body)
+        self._reply(200, b'', content_type='text/plain')
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeElbv2Server(_Server):
+    """Fake ELBv2 endpoint serving DescribeRules for `listeners`, a dict of listener ARN to rule priorities.
+
+    `latency` adds a fixed delay in seconds to every call, and `throttle_rate` is the probability
+    that a call is rejected with a Throttling error, drawn from a generator seeded with `seed`.
+    """
+
+    def __init__(self, listeners=None, latency=0.0, throttle_rate=0.0, seed=0):
+        super().__init__(_Elbv2Handler)
+        self.listeners = listeners or {}
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self._random = random.Random(seed)
+
+    def should_throttle(self):
+        with self.lock:
+            return self._random.random() < self.throttle_rate
+
+
+def make_listener_priorities(rule_count, priority_range=(1, 50000), seed=0):
+    """Return `rule_count` distinct random priorities in `priority_range` for a simulated listener."""
+    low, high = priority_range
+    return sorted(random.Random(seed).sample(range(low, high + 1), rule_count))
+
+
+class ResponseServer(_Server):
+    """Stand-in for the pre-signed CloudFormation response URL, recording every response body."""
+
+    def __init__(self):
+        super().__init__(_ResponseHandler)
+        self.responses = []
+
+    @property
+    def response_url(self):
+        return f'{self.url}/response?X-Amz-Signature=benchmark'
@@ -0,0 +1,135 @@
+"""Allocation benchmark suite against a simulated ELBv2 listener.
+
+Each scenario runs full custom resource invocations through index.handler with the real boto3
+client pointed at FakeElbv2Server, which serves paginated DescribeRules for a listener with the
+given number of rules and can throttle a fraction of calls. Reported per scenario:
+
+    latency_p50_ms / latency_p95_ms   wall-clock time per invocation
+    api_calls_per_request             DescribeRules calls (including throttled ones) per invocation
+    peak_kib                          peak traced memory while the scenario runs
+    latency_p50_ratio                 latency_p50_ms over the reference scenario's in the same run,
+                                      which unlike the absolute timings is comparable across machines
+
+Usage:
+    python -m benchmarks.suite [--requests N] [--check] [--update-baselines]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import baselines
+from benchmarks.servers import AWS_ENVIRONMENT, FakeElbv2Server, ResponseServer, make_listener_priorities
+from src import index
+
+LISTENER_ARN = 'arn:aws:elasticloadbalancing:us-east-1:123456789012:listener/app/bench/0123456789abcdef/0123456789abcdef'
+
+# name: (rules on the listener, PriorityCount, concurrent invocations, throttle rate)
+SCENARIOS = {
+    'single-empty': (0, None, 1, 0.0),
+    'single-100-rules': (100, None, 1, 0.0),
+    'single-1000-rules': (1000, None, 1, 0.0),
+    'count20-100-rules': (100, 20, 1, 0.0),
+    'count20-1000-rules': (1000, 20, 1, 0.0),
+    'concurrent8-100-rules': (100, 2, 8, 0.0),
+    'throttled-100-rules': (100, 2, 1, 0.3),
+}
+# Always run, as the baseline latency_p50_ratio is measured against
+REFERENCE_SCENARIO = 'single-empty'
+
+
+class Context:
+    log_stream_name = 'benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 30000
+
+
+def make_event(response_url, priority_count):
+    event = {
+        'RequestType': 'Create',
+        'ResponseURL': response_url,
+        'StackId': f'arn:aws:cloudformation:us-east-1:123456789012:stack/bench/{uuid.uuid4()}',
+        'RequestId': str(uuid.uuid4()),
+        'LogicalResourceId': 'ListenerRuleAllocation',
+        'ResourceProperties': {'ListenerArn': LISTENER_ARN},
+    }
+    if priority_count:
+        event['ResourceProperties']['PriorityCount'] = str(priority_count)
+    return event
+
+
+def reset_container():
+    """Forget everything a warm container would remember, so each invocation starts cold."""
+    index._RULE_SNAPSHOTS.clear()
+    index._RESERVATIONS.clear()
+    # Each round stands in for a fresh container with a full burst, so rounds do not wait on earlier ones' tokens
+    index._ELBV2_LIMITER = index.TokenBucket(index.ELBV2_RATE_LIMIT, index.ELBV2_BURST)
+
+
+def invoke(response_url, priority_count):
+    started = time.perf_counter()
+    index.handler(make_event(response_url, priority_count), Context())
+    return (time.perf_counter() - started) * 1000
+
+
+def run_scenario(rules, priority_count, concurrency, throttle_rate, requests, page_size):
+    priorities = make_listener_priorities(rules)
+    with FakeElbv2Server({LISTENER_ARN: priorities}, throttle_rate=throttle_rate) as elbv2, ResponseServer() as responses:
+        os.environ['AWS_ENDPOINT_URL_ELASTIC_LOAD_BALANCING_V2'] = elbv2.url
+        index._ELBV2_CLIENT = None
+        index.get_elbv2_client()
+
+        latencies = []
+        tracemalloc.start()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for _ in range(requests):
+                reset_container()
+                latencies.extend(executor.map(lambda _: invoke(responses.response_url, priority_count), range(concurrency)))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        failed = [r for r in responses.responses if r['Status'] != 'SUCCESS']
+        if failed:
+            raise RuntimeError(f"{len(failed)} invocations failed: {failed[0]['Reason']}")
+
+        latencies.sort()
+        return {
+            'latency_p50_ms': statistics.median(latencies),
+            'latency_p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'api_calls_per_request': elbv2.calls['DescribeRules'] / len(latencies),
+            'peak_kib': peak / 1024,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20, help='invocation rounds per scenario')
+    parser.add_argument('--page-size', type=int, default=index.DESCRIBE_RULES_PAGE_SIZE, help='DescribeRules PageSize')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='run only these scenarios')
+    baselines.add_arguments(parser)
+    args = parser.parse_args()
+
+    os.environ.update(AWS_ENVIRONMENT)
+    index.METRICS_ENABLED = False
+    index.DESCRIBE_RULES_PAGE_SIZE = args.page_size
+
+    metrics = {}
+    print(f"{'scenario':>22} {'p50 ms':>8} {'p95 ms':>8} {'calls/req':>10} {'peak KiB':>9} {'p50 ratio':>10}")
+    for name in dict.fromkeys([REFERENCE_SCENARIO, *(args.scenario or SCENARIOS)]):
+        result = run_scenario(*SCENARIOS[name], requests=args.requests, page_size=args.page_size)
+        if name != REFERENCE_SCENARIO:
+            result['latency_p50_ratio'] = result['latency_p50_ms'] / metrics[f'{REFERENCE_SCENARIO}.latency_p50_ms']
+        print(f"{name:>22} {result['latency_p50_ms']:>8.2f} {result['latency_p95_ms']:>8.2f} {result['api_calls_per_request']:>10.2f} "
+              f"{result['peak_kib']:>9.1f} {result.get('latency_p50_ratio', 1):>10.2f}")
+        metrics.update({f'{name}.{metric}': value for metric, value in result.items()})
+
+    return baselines.compare('suite', metrics, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,44 +1,1254 @@
+import abc
+import bisect
+import hashlib
+import itertools
 import json
+import logging
 import os
 import random
+import re
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 from urllib.parse import urlparse
 import http.client
 
-import boto3
+# boto3, botocore and the optional backends are imported where they are first needed, so Delete
+# requests and requests that fail validation do not pay for them on a cold start.
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
 
 SUCCESS = "SUCCESS"
 FAILED = "FAILED"
 ALB_RULE_PRIORITY_RANGE = 10000, 50000
-ALLOCATING = []
+ALB_MAX_PRIORITY = 50000
+DESCRIBE_RULES_PAGE_SIZE = int(os.environ.get('DESCRIBE_RULES_PAGE_SIZE', 400))
+RULE_SNAPSHOT_TTL = float(os.environ.get('RULE_SNAPSHOT_TTL', 10))
+RULE_SNAPSHOT_CACHE_SIZE = int(os.environ.get('RULE_SNAPSHOT_CACHE_SIZE', 16))
+LISTENER_CONCURRENCY = int(os.environ.get('LISTENER_CONCURRENCY', 8))
+ALLOCATION_STRATEGY = os.environ.get('ALLOCATION_STRATEGY', 'random')
+ALLOCATION_STRATEGIES = ('random', 'hashed')
+ELBV2_RATE_LIMIT = float(os.environ.get('ELBV2_RATE_LIMIT', 10))
+ELBV2_BURST = int(os.environ.get('ELBV2_BURST', 10))
+ELBV2_MAX_ATTEMPTS = int(os.environ.get('ELBV2_MAX_ATTEMPTS', 5))
+ELBV2_RETRY_MODE = os.environ.get('ELBV2_RETRY_MODE', 'client')
+ELBV2_BACKOFF_BASE = 0.2
+ELBV2_BACKOFF_CAP = 5
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException')
+SEND_CONNECT_TIMEOUT = float(os.environ.get('SEND_CONNECT_TIMEOUT', 5))
+SEND_READ_TIMEOUT = float(os.environ.get('SEND_READ_TIMEOUT', 10))
+SEND_MAX_ATTEMPTS = int(os.environ.get('SEND_MAX_ATTEMPTS', 5))
+SEND_BACKOFF_BASE = 0.5
+SEND_BACKOFF_CAP = 8
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ALBDynamicPriority')
+RESERVATION_BACKEND = os.environ.get('RESERVATION_BACKEND')
+RESERVATION_TABLE = os.environ.get('RESERVATION_TABLE')
+RESERVATION_DB_PATH = os.environ.get('RESERVATION_DB_PATH', '/tmp/alb-rule-priority-reservations.db')
+RESERVATION_TTL = int(os.environ.get('RESERVATION_TTL', 3600))
+RESERVATION_MAX_ATTEMPTS = int(os.environ.get('RESERVATION_MAX_ATTEMPTS', 5))
+PHYSICAL_RESOURCE_ID_MAX_LENGTH = 1024
+# Properties that never change which priorities a resource holds: Verify only re-checks them before responding,
+# and Rebalance only matters when a Before/After gap is full
+UPDATE_IGNORED_PROPERTIES = ('ServiceToken', 'Verify', 'Rebalance')
+LOCAL_RESERVATION_TTL = float(os.environ.get('LOCAL_RESERVATION_TTL', 900))
+LOCAL_RESERVATION_MAX = int(os.environ.get('LOCAL_RESERVATION_MAX', 1000))
+VERIFY_ALLOCATIONS = os.environ.get('VERIFY_ALLOCATIONS', 'false').lower() == 'true'
+VERIFY_TIME_BUDGET = float(os.environ.get('VERIFY_TIME_BUDGET', 2))
+CACHE_STATS = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
+# Reused across invocations of a warm container
+_ELBV2_CLIENT = None
+_LOCK = threading.Lock()
+_RULE_SNAPSHOTS = OrderedDict()
+# listener ARN -> Future of the describe_rules read in progress
+_IN_FLIGHT = {}
+_LISTENER_LOCKS = {}
+# listener ARN -> OrderedDict of priority -> (expiry, owner), oldest first
+_RESERVATIONS = {}
+# (listener ARN, priorities, owner) handed out by the current invocation
+_INVOCATION_ALLOCATIONS = []
+_RESERVATION_BACKEND = None
+_HTTP = threading.local()
+_METRICS = {}
+_METRICS_LOCK = threading.Lock()
 
 
 def handler(event, context):
+    if event.get('Action') == 'AnalyzeListeners':
+        try:
+            return analyze_listeners(event)
+        finally:
+            flush_metrics({'RequestType': 'AnalyzeListeners'})
+
+    if 'Records' in event:
+        try:
+            return handle_records(event['Records'], context)
+        finally:
+            flush_metrics({'RequestType': 'Batch'})
+
+    try:
+        _process_event(event, context)
+    finally:
+        flush_metrics({'RequestType': event.get('RequestType', 'Unknown')})
+
+
+def _process_event(event, context, respond=None):
+    """Run one event through _lambda_handler; if it raises, release what it allocated and respond FAILED."""
+    respond = respond or send
+    _INVOCATION_ALLOCATIONS.clear()
+    try:
+        return _lambda_handler(event, context, respond)
+    except Exception as e:
+        logger.exception("Request failed")
+        if event['RequestType'] != 'Delete':
+            for listener_arn, priorities, owner in _INVOCATION_ALLOCATIONS:
+                release_priorities(listener_arn, priorities, owner, unused=True)
+        respond(event, context, response_status=FAILED if event['RequestType'] != 'Delete' else SUCCESS, response_data=None, physical_resource_id=str(uuid.uuid4()), reason=str(e))
+        raise
+
+
+def parse_record(record):
+    """Return the custom resource event carried by an SNS or SQS record, unwrapping SNS notifications delivered through SQS."""
+    if 'Sns' in record:
+        return json.loads(record['Sns']['Message'])
+    message = json.loads(record['body'])
+    if message.get('Type') == 'Notification' and 'Message' in message:
+        return json.loads(message['Message'])
+    return message
+
+
+def prefetch_rule_snapshots(listener_arns):
+    """Read the snapshots of several listeners concurrently so the events that need them are served from the cache.
+
+    A listener that cannot be read is skipped here; the error surfaces on the events that use it.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not listener_arns:
+        return
+    get_elbv2_client()
+    with ThreadPoolExecutor(max_workers=min(LISTENER_CONCURRENCY, len(listener_arns))) as executor:
+        for listener_arn, future in [(arn, executor.submit(get_rule_snapshot, arn)) for arn in listener_arns]:
+            if future.exception():
+                logger.warning("Could not prefetch rules of %s: %r", listener_arn, future.exception())
+
+
+async def _send_all(responses):
+    import asyncio
+
+    return await asyncio.gather(*(asyncio.to_thread(send, *args, **kwargs) for args, kwargs in responses), return_exceptions=True)
+
+
+def handle_records(records, context):
+    """Process a batch of custom resource events delivered as SNS or SQS records.
+
+    The listeners of every Create and Update are read up front, one describe_rules per listener,
+    the events are then resolved one after another from those snapshots, and the responses are
+    sent to CloudFormation concurrently. Returns an SQS partial batch response listing the records
+    that could not be parsed or whose response could not be delivered, so only those are retried.
+    """
+    import asyncio
+
+    events = []
+    failures = []
+    for record in records:
+        try:
+            events.append((record, parse_record(record)))
+        except (KeyError, ValueError) as e:
+            logger.error("Skipping unreadable record %s: %r", record.get('messageId'), e)
+            failures.append(record)
+
+    listener_arns = []
+    for _, event in events:
+        if event.get('RequestType') in ('Create', 'Update'):
+            request_properties = event.get('ResourceProperties', {})
+            listener_arns.extend(get_request_listener_arns(request_properties) or [request_properties.get('ListenerArn')])
+    prefetch_rule_snapshots([arn for arn in dict.fromkeys(listener_arns) if arn])
+
+    responses = []
+    owners = []
+    for record, event in events:
+        position = len(responses)
+        try:
+            _process_event(event, context, respond=lambda *args, **kwargs: responses.append((args, kwargs)))
+        except Exception:
+            # Already logged, and a FAILED response is queued for CloudFormation
+            pass
+        owners.extend([record] * (len(responses) - position))
+
+    statuses = asyncio.run(_send_all(responses))
+    for record, status in zip(owners, statuses):
+        # Responses CloudFormation rejected outright would be rejected again, so only undelivered ones are retried
+        if not isinstance(status, int) or status == 429 or status >= 500:
+            logger.error("Response for record %s was not delivered: %r", record.get('messageId'), status)
+            failures.append(record)
+    put_metric('BatchRecords', len(records))
+    put_metric('BatchFailures', len(failures))
+    return {'batchItemFailures': [{'itemIdentifier': record['messageId']} for record in failures if 'messageId' in record]}
+
+
+def put_metric(name, value, unit='Count'):
+    """Record a metric value for this invocation; values are emitted together by flush_metrics."""
+    with _METRICS_LOCK:
+        _METRICS.setdefault(name, (unit, []))[1].append(value)
+
+
+@contextmanager
+def timed(name):
+    """Record the wall-clock duration of the block as a millisecond metric."""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        put_metric(name, (time.monotonic() - started) * 1000, 'Milliseconds')
+
+
+def flush_metrics(dimensions):
+    """Write the metrics recorded since the last flush as one CloudWatch Embedded Metric Format line."""
+    with _METRICS_LOCK:
+        metrics = dict(_METRICS)
+        _METRICS.clear()
+    if not metrics or not METRICS_ENABLED:
+        return
+
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (unit, _) in metrics.items()],
+            }],
+        },
+        **dimensions,
+    }
+    for name, (_, values) in metrics.items():
+        document[name] = values if len(values) > 1 else values[0]
+    # EMF is picked up from stdout, independently of the log level
+    print(json.dumps(document))
+
+
+def get_alb_rule_priority(listener_arn, owner=None, priority_range=ALB_RULE_PRIORITY_RANGE, **kwargs):
+    return get_alb_rule_priorities(listener_arn, 1, owner, priority_range=priority_range, **kwargs)[0]
+
+
+def parse_priority_range(value):
+    """Parse a "low-high" PriorityRange property into a (low, high) tuple within the ALB priority space."""
+    try:
+        low, high = (int(part) for part in str(value).split('-'))
+    except ValueError:
+        raise ValueError(f"PriorityRange must look like 'low-high', got {value!r}") from None
+    if not 1 <= low <= high <= ALB_MAX_PRIORITY:
+        raise ValueError(f"PriorityRange must satisfy 1 <= low <= high <= {ALB_MAX_PRIORITY}, got {value!r}")
+    return low, high
+
+
+def shard_priority_range(priority_range, shard_count, shard_key):
+    """Return the sub-range of `priority_range` that `shard_key` maps to when it is split into `shard_count` shards.
+
+    The shard is picked from a hash of the key, so the same stack or tenant always lands on the
+    same sub-range and only competes with the keys that hash to it.
+    """
+    low, high = priority_range
+    size = high - low + 1
+    if not 1 <= shard_count <= size:
+        raise ValueError(f"ShardCount must be between 1 and {size} for range {low}-{high}, got {shard_count}")
+    shard = int.from_bytes(hashlib.sha256(shard_key.encode()).digest()[:8], 'big') % shard_count
+    return low + size * shard // shard_count, low + size * (shard + 1) // shard_count - 1
+
+
+def hash_priority(key, index, priority_range):
+    """Map `key` and `index` to a priority in `priority_range`, the starting point of a hashed allocation."""
+    low, high = priority_range
+    return low + int.from_bytes(hashlib.sha256(f"{key}|{index}".encode()).digest()[:8], 'big') % (high - low + 1)
+
+
+def get_request_priority_range(request_properties, event):
+    """Resolve the priority range for a request from its PriorityRange, ShardCount and ShardKey properties."""
+    priority_range = ALB_RULE_PRIORITY_RANGE
+    if request_properties.get('PriorityRange'):
+        priority_range = parse_priority_range(request_properties['PriorityRange'])
+    if request_properties.get('ShardCount'):
+        shard_key = request_properties.get('ShardKey') or event['StackId']
+        priority_range = shard_priority_range(priority_range, int(request_properties['ShardCount']), shard_key)
+    return priority_range
+
+
+def iter_rules(elbv2_client, listener_arn, page_size=DESCRIBE_RULES_PAGE_SIZE):
+    """Yield a listener's rules, one describe_rules page at a time."""
+    kwargs = {'ListenerArn': listener_arn, 'PageSize': page_size}
+    while True:
+        with timed('DescribeRulesTime'):
+            result = call_elbv2(elbv2_client.describe_rules, **kwargs)
+        put_metric('DescribeRulesCalls', 1)
+        yield from result['Rules']
+
+        marker = result.get('NextMarker')
+        if not marker:
+            return
+        kwargs['Marker'] = marker
+
+
+def iter_rule_priorities(elbv2_client, listener_arn, page_size=DESCRIBE_RULES_PAGE_SIZE):
+    """Yield the numeric priorities of a listener's rules, one describe_rules page at a time."""
+    for rule in iter_rules(elbv2_client, listener_arn, page_size):
+        if rule['Priority'].isdecimal():
+            yield int(rule['Priority'])
+
+
+def get_listener_occupancy(elbv2_client, listener_arn, page_size=DESCRIBE_RULES_PAGE_SIZE):
+    """Return a bytearray indexed by priority where a non-zero byte marks a priority in use.
+
+    The array is sized to the ALB priority space, so memory stays fixed no matter how many
+    rules or pages the listener has, and membership checks are a single index lookup.
+    """
+    occupancy = bytearray(ALB_MAX_PRIORITY + 1)
+    for priority in iter_rule_priorities(elbv2_client, listener_arn, page_size):
+        occupancy[priority] = 1
+    return occupancy
+
+
+class TokenBucket:
+    """Client-side rate limiter shared by every ELBv2 call in the container.
+
+    Calls take a token, waiting for one to be refilled if needed. Throttling halves the refill
+    rate and each successful call wins back a tenth of the configured rate, so the container
+    settles just below the rate the API is willing to serve.
+    """
+
+    def __init__(self, rate, capacity, min_rate=0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + max(0, now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+_ELBV2_LIMITER = TokenBucket(ELBV2_RATE_LIMIT, ELBV2_BURST)
+
+
+def get_elbv2_client():
+    """Return the container's ELBv2 client.
+
+    With ELBV2_RETRY_MODE=adaptive botocore's own adaptive retry mode does the rate limiting and
+    retries. Otherwise botocore makes a single attempt per call, so call_elbv2 and the shared token
+    bucket are the only retry layer and see every throttle.
+    """
+    global _ELBV2_CLIENT
+    with _LOCK:
+        if _ELBV2_CLIENT is None:
+            import boto3
+            from botocore.config import Config
+            if ELBV2_RETRY_MODE == 'adaptive':
+                config = Config(retries={'mode': 'adaptive', 'max_attempts': ELBV2_MAX_ATTEMPTS})
+            else:
+                config = Config(retries={'mode': 'standard', 'total_max_attempts': 1})
+            _ELBV2_CLIENT = boto3.client('elbv2', config=config)
+    return _ELBV2_CLIENT
+
+
+def call_elbv2(method, **kwargs):
+    """Call an ELBv2 client method through the shared rate limiter, retrying throttling with jittered backoff."""
+    if ELBV2_RETRY_MODE == 'adaptive':
+        return method(**kwargs)
+
+    from botocore.exceptions import ClientError
+
+    for attempt in range(1, ELBV2_MAX_ATTEMPTS + 1):
+        _ELBV2_LIMITER.acquire()
+        try:
+            result = method(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLING_ERROR_CODES or attempt == ELBV2_MAX_ATTEMPTS:
+                raise
+            _ELBV2_LIMITER.on_throttle()
+            put_metric('ThrottledCalls', 1)
+            delay = random.uniform(0, min(ELBV2_BACKOFF_CAP, ELBV2_BACKOFF_BASE * 2 ** attempt))
+            logger.warning("ELBv2 call throttled, retrying in %.2fs (attempt %d)", delay, attempt)
+            time.sleep(delay)
+        else:
+            _ELBV2_LIMITER.on_success()
+            return result
+
+
+def get_listener_lock(listener_arn):
+    with _LOCK:
+        return _LISTENER_LOCKS.setdefault(listener_arn, threading.Lock())
+
+
+def get_rule_snapshot(listener_arn, force_refresh=False):
+    """Return the occupancy of a listener from the snapshot cache, reading describe_rules on a miss.
+
+    Snapshots expire after RULE_SNAPSHOT_TTL seconds and the least recently used listener is
+    evicted once more than RULE_SNAPSHOT_CACHE_SIZE are cached. The returned bytearray is the
+    cached one, so marking allocated priorities in it keeps the snapshot current.
+    """
+    now = time.monotonic()
+    with _LOCK:
+        snapshot = _RULE_SNAPSHOTS.get(listener_arn)
+        if snapshot and not force_refresh and now - snapshot[0] < RULE_SNAPSHOT_TTL:
+            CACHE_STATS['hits'] += 1
+            _RULE_SNAPSHOTS.move_to_end(listener_arn)
+            put_metric('SnapshotCacheHits', 1)
+            return snapshot[1]
+
+        # Requests for a listener that is already being read wait for that read instead of making their own
+        in_flight = _IN_FLIGHT.get(listener_arn)
+        if in_flight is None:
+            from concurrent.futures import Future
+            _IN_FLIGHT[listener_arn] = future = Future()
+            CACHE_STATS['misses'] += 1
+        else:
+            CACHE_STATS['coalesced'] += 1
+
+    if in_flight is not None:
+        put_metric('SnapshotCoalesced', 1)
+        return in_flight.result()
+    put_metric('SnapshotCacheMisses', 1)
+
     try:
-        _lambda_handler(event, context)
+        occupancy = get_listener_occupancy(get_elbv2_client(), listener_arn)
     except Exception as e:
-        send(event, context, response_status=FAILED if event['RequestType'] != 'Delete' else SUCCESS, response_data=None, physical_resource_id=str(uuid.uuid4()), reason=str(e))
+        with _LOCK:
+            del _IN_FLIGHT[listener_arn]
+        future.set_exception(e)
         raise
 
+    with _LOCK:
+        del _IN_FLIGHT[listener_arn]
+        # Reservations the listener now has rules for are confirmed and no longer need tracking
+        reservations = _RESERVATIONS.get(listener_arn, {})
+        for priority in [p for p in reservations if occupancy[p]]:
+            del reservations[priority]
+        _RULE_SNAPSHOTS[listener_arn] = (now, occupancy)
+        _RULE_SNAPSHOTS.move_to_end(listener_arn)
+        while len(_RULE_SNAPSHOTS) > RULE_SNAPSHOT_CACHE_SIZE:
+            _RULE_SNAPSHOTS.popitem(last=False)
+    future.set_result(occupancy)
+    return occupancy
+
+
+def reserve_priorities(listener_arn, priorities, owner=None, physical_resource_id=None):
+    """Track priorities handed out by this container until they expire, are confirmed or are released.
+
+    Each listener keeps at most LOCAL_RESERVATION_MAX reservations, oldest evicted first.
+    `physical_resource_id` tags the reservations with the resource id holding them, see hold_priorities.
+    """
+    expires_at = time.monotonic() + LOCAL_RESERVATION_TTL
+    with _LOCK:
+        reservations = _RESERVATIONS.setdefault(listener_arn, OrderedDict())
+        for priority in priorities:
+            reservations[priority] = expires_at, owner, physical_resource_id
+            reservations.move_to_end(priority)
+        while len(reservations) > LOCAL_RESERVATION_MAX:
+            reservations.popitem(last=False)
+
+
+def get_reserved_priorities(listener_arn, owner=None, other_owners=False):
+    """Return the unexpired priorities this container has reserved on a listener.
+
+    With `owner` only that owner's reservations are returned, or with `other_owners` everyone else's.
+    """
+    now = time.monotonic()
+    with _LOCK:
+        for arn in list(_RESERVATIONS):
+            reservations = _RESERVATIONS[arn]
+            while reservations and next(iter(reservations.values()))[0] <= now:
+                reservations.popitem(last=False)
+            if not reservations:
+                del _RESERVATIONS[arn]
+        reservations = _RESERVATIONS.get(listener_arn, {})
+        if owner is None:
+            return list(reservations)
+        return [priority for priority, (_, holder, _) in reservations.items() if (holder == owner) != other_owners]
+
+
+def release_priorities(listener_arn, priorities, owner, unused=False, physical_resource_id=None):
+    """Release priorities held by `owner` locally and in the reservation backend.
+
+    With `unused` the priorities were never given to a listener rule, so they are also cleared
+    from the cached snapshot and can be handed out again straight away. With `physical_resource_id`
+    only untagged priorities and those tagged with that id are released, so deleting a replaced
+    resource id leaves alone the priorities its successor kept.
+    """
+    priorities = [int(priority) for priority in priorities]
+    with _LOCK:
+        reservations = _RESERVATIONS.get(listener_arn, {})
+        for priority in priorities:
+            if physical_resource_id is None or reservations.get(priority, (0, None, None))[2] in (None, physical_resource_id):
+                reservations.pop(priority, None)
+        if unused and listener_arn in _RULE_SNAPSHOTS:
+            occupancy = _RULE_SNAPSHOTS[listener_arn][1]
+            for priority in priorities:
+                occupancy[priority] = 0
+
+    backend = get_reservation_backend()
+    if backend:
+        backend.release(listener_arn, priorities, owner, physical_resource_id)
+    logger.info("Released priorities %s on %s", priorities, listener_arn)
 
-def get_alb_rule_priority(listener_arn):
-    global ALLOCATING
-    elbv2_client = boto3.client('elbv2')
 
-    result = elbv2_client.describe_rules(ListenerArn=listener_arn)
-    in_use = list(filter(lambda s: s.isdecimal(), [r['Priority'] for r in result['Rules']]))
+def hold_priorities(listener_arn, priorities, owner, physical_resource_id):
+    """Tag priorities `owner` keeps across an Update with the resource's new physical id.
 
-    priority = None
-    while not priority:
-        new_priority = str(random.randint(*ALB_RULE_PRIORITY_RANGE))
-        if new_priority and new_priority not in in_use and new_priority not in ALLOCATING:
-            ALLOCATING.append(priority)
-            priority = new_priority
+    When an Update changes the PhysicalResourceId, CloudFormation follows up with a Delete of the
+    old id. That Delete only releases priorities that are untagged or tagged with the old id, so
+    the ones re-tagged here stay held.
+    """
+    priorities = [int(priority) for priority in priorities]
+    reserve_priorities(listener_arn, priorities, owner, physical_resource_id)
+    backend = get_reservation_backend()
+    if backend:
+        lost = set(priorities) - set(backend.claim(listener_arn, priorities, owner, physical_resource_id))
+        if lost:
+            logger.warning("Priorities %s on %s are now claimed by another resource", sorted(lost), listener_arn)
+
+
+class ReservationBackend(abc.ABC):
+    """Shared ledger of claimed priorities, visible to every container allocating on a listener.
+
+    Claims are keyed on (listener ARN, priority) and are conditional: a priority can only be
+    claimed when nobody holds it, its previous claim has expired, or `owner` already holds it,
+    which makes retried claims for the same resource idempotent. A claim may be tagged with the
+    physical resource id holding it, which a release for a different id leaves alone.
+    """
+
+    @abc.abstractmethod
+    def claim(self, listener_arn, priorities, owner, physical_resource_id=None):
+        """Claim priorities for `owner` and return the ones that were claimed."""
+
+    @abc.abstractmethod
+    def release(self, listener_arn, priorities, owner, physical_resource_id=None):
+        """Release priorities held by `owner`; priorities held by anyone else are left alone.
+
+        With `physical_resource_id` only untagged claims and claims tagged with that id are released.
+        """
+
+
+class DynamoDBReservationBackend(ReservationBackend):
+    """Reservation ledger in a DynamoDB table keyed on ListenerArn (S) and Priority (N).
+
+    Claims are written with conditional puts in TransactWriteItems batches. A batch cancelled by a
+    transaction conflict or throttling is retried with jittered backoff, and priorities still not
+    written after MAX_ATTEMPTS are reported as not claimed. Enable DynamoDB TTL on the ExpiresAt
+    attribute to have abandoned claims removed from the table.
+    """
+
+    BATCH_SIZE = 100
+    # Cancellation reasons that say nothing about who holds the priority, so the claim is retried
+    RETRYABLE_REASONS = ('TransactionConflict', 'ThrottlingError', 'ProvisionedThroughputExceeded')
+    MAX_ATTEMPTS = 5
+    BACKOFF_BASE = 0.05
+    BACKOFF_CAP = 1.0
+
+    def __init__(self, table_name, client=None):
+        if client is None:
+            import boto3
+            client = boto3.client('dynamodb')
+        self.table_name = table_name
+        self.client = client
+
+    def claim(self, listener_arn, priorities, owner, physical_resource_id=None):
+        from botocore.exceptions import ClientError
+
+        claimed = []
+        for offset in range(0, len(priorities), self.BATCH_SIZE):
+            pending = list(priorities[offset:offset + self.BATCH_SIZE])
+            attempt = 0
+            while pending:
+                try:
+                    self.client.transact_write_items(TransactItems=[self._put(listener_arn, priority, owner, physical_resource_id) for priority in pending])
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'TransactionCanceledException':
+                        raise
+                    reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+                    conflicts = {priority for priority, reason in zip(pending, reasons) if reason == 'ConditionalCheckFailed'}
+                    retryable = {priority for priority, reason in zip(pending, reasons) if reason in self.RETRYABLE_REASONS}
+                    if not conflicts and not retryable:
+                        raise
+                    # Rounds cancelled only by conflicts shrink `pending`, so only throttled rounds use up attempts
+                    attempt += bool(retryable)
+                    if retryable and attempt >= self.MAX_ATTEMPTS:
+                        # Treated like conflicts, so the allocator picks other priorities instead
+                        logger.warning("Giving up claiming priorities %s on %s after %d attempts", sorted(retryable), listener_arn, attempt)
+                        conflicts |= retryable
+                    elif retryable:
+                        time.sleep(random.uniform(0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** attempt)))
+                    pending = [priority for priority in pending if priority not in conflicts]
+                else:
+                    claimed.extend(pending)
+                    pending = []
+        return claimed
+
+    def release(self, listener_arn, priorities, owner, physical_resource_id=None):
+        from botocore.exceptions import ClientError
+
+        condition = {
+            'ConditionExpression': '#owner = :owner',
+            'ExpressionAttributeNames': {'#owner': 'Owner'},
+            'ExpressionAttributeValues': {':owner': {'S': owner}},
+        }
+        if physical_resource_id is not None:
+            condition['ConditionExpression'] += ' AND (attribute_not_exists(#resource) OR #resource = :resource)'
+            condition['ExpressionAttributeNames']['#resource'] = 'PhysicalResourceId'
+            condition['ExpressionAttributeValues'][':resource'] = {'S': physical_resource_id}
+        for priority in priorities:
+            try:
+                self.client.delete_item(
+                    TableName=self.table_name,
+                    Key={'ListenerArn': {'S': listener_arn}, 'Priority': {'N': str(priority)}},
+                    **condition,
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+
+    def _put(self, listener_arn, priority, owner, physical_resource_id=None):
+        now = int(time.time())
+        item = {
+            'ListenerArn': {'S': listener_arn},
+            'Priority': {'N': str(priority)},
+            'Owner': {'S': owner},
+            'ExpiresAt': {'N': str(now + RESERVATION_TTL)},
+        }
+        if physical_resource_id is not None:
+            item['PhysicalResourceId'] = {'S': physical_resource_id}
+        return {'Put': {
+            'TableName': self.table_name,
+            'Item': item,
+            'ConditionExpression': 'attribute_not_exists(#priority) OR #owner = :owner OR ExpiresAt < :now',
+            'ExpressionAttributeNames': {'#priority': 'Priority', '#owner': 'Owner'},
+            'ExpressionAttributeValues': {':owner': {'S': owner}, ':now': {'N': str(now)}},
+        }}
+
+
+class SQLiteReservationBackend(ReservationBackend):
+    """Reservation ledger in a local SQLite file, for tests and single-container deployments."""
+
+    def __init__(self, path):
+        import sqlite3
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS reservations ('
+            'listener_arn TEXT NOT NULL, priority INTEGER NOT NULL, owner TEXT NOT NULL, expires_at REAL NOT NULL, '
+            'physical_resource_id TEXT, PRIMARY KEY (listener_arn, priority))'
+        )
+        # Ledgers created before claims were tagged lack the column
+        columns = {row[1] for row in self._connection.execute('PRAGMA table_info(reservations)')}
+        if 'physical_resource_id' not in columns:
+            self._connection.execute('ALTER TABLE reservations ADD COLUMN physical_resource_id TEXT')
+
+    def claim(self, listener_arn, priorities, owner, physical_resource_id=None):
+        now = time.time()
+        claimed = []
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                for priority in priorities:
+                    cursor = self._connection.execute(
+                        'INSERT INTO reservations (listener_arn, priority, owner, expires_at, physical_resource_id) VALUES (?, ?, ?, ?, ?) '
+                        'ON CONFLICT (listener_arn, priority) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at, '
+                        'physical_resource_id = excluded.physical_resource_id '
+                        'WHERE reservations.owner = excluded.owner OR reservations.expires_at < ?',
+                        (listener_arn, priority, owner, now + RESERVATION_TTL, physical_resource_id, now),
+                    )
+                    if cursor.rowcount:
+                        claimed.append(priority)
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+        return claimed
+
+    def release(self, listener_arn, priorities, owner, physical_resource_id=None):
+        with self._lock:
+            self._connection.executemany(
+                'DELETE FROM reservations WHERE listener_arn = ? AND priority = ? AND owner = ? '
+                'AND (? IS NULL OR physical_resource_id IS NULL OR physical_resource_id = ?)',
+                [(listener_arn, priority, owner, physical_resource_id, physical_resource_id) for priority in priorities],
+            )
+
+
+def get_reservation_backend():
+    """Return the reservation backend selected by RESERVATION_BACKEND, or None when it is unset."""
+    global _RESERVATION_BACKEND
+    if _RESERVATION_BACKEND is None and RESERVATION_BACKEND:
+        if RESERVATION_BACKEND == 'dynamodb':
+            if not RESERVATION_TABLE:
+                raise ValueError("RESERVATION_TABLE must be set when RESERVATION_BACKEND is 'dynamodb'")
+            _RESERVATION_BACKEND = DynamoDBReservationBackend(RESERVATION_TABLE)
+        elif RESERVATION_BACKEND == 'sqlite':
+            _RESERVATION_BACKEND = SQLiteReservationBackend(RESERVATION_DB_PATH)
+        else:
+            raise ValueError(f"Unknown RESERVATION_BACKEND: {RESERVATION_BACKEND}")
+    return _RESERVATION_BACKEND
+
+
+class PriorityRangeExhaustedError(Exception):
+    """Raised when a priority range has too few free priorities left for a request."""
+
+
+class PriorityAllocator:
+    """Index of the free priorities in a range, kept as sorted, disjoint [start, end] intervals.
+
+    A random point in the range is mapped to the free interval containing it (or the next one)
+    with a binary search, so each allocation is O(log n) in the number of free intervals and
+    a full range fails immediately instead of sampling forever.
+    """
 
-    return priority
+    def __init__(self, occupancy, priority_range=ALB_RULE_PRIORITY_RANGE):
+        low, high = priority_range
+        self.priority_range = (low, high)
+        self.size = high - low + 1
+        self._starts = []
+        self._ends = []
 
+        position = low
+        while position <= high:
+            used = occupancy.find(1, position, high + 1)
+            end = high if used == -1 else used - 1
+            if end >= position:
+                self._starts.append(position)
+                self._ends.append(end)
+            if used == -1:
+                break
+            position = used + 1
 
-def _lambda_handler(event, context):
+        self.free = sum(end - start + 1 for start, end in zip(self._starts, self._ends))
+
+    @property
+    def used(self):
+        return self.size - self.free
+
+    @property
+    def utilisation(self):
+        return self.used / self.size
+
+    def extents(self):
+        """Return the free intervals as (start, end) pairs in priority order."""
+        return list(zip(self._starts, self._ends))
+
+    def allocate(self, target=None):
+        """Take the free priority at `target`, or the next free one after it, out of the index and return it.
+
+        Without `target` a random point in the range is used.
+        """
+        if not self.free:
+            raise PriorityRangeExhaustedError(f"No free priorities left in range {self.priority_range[0]}-{self.priority_range[1]}")
+
+        if target is None:
+            target = random.randint(*self.priority_range)
+        index = bisect.bisect_right(self._starts, target) - 1
+        if index < 0 or target > self._ends[index]:
+            index = (index + 1) % len(self._starts)
+            target = self._starts[index]
+
+        self._take(index, target)
+        return target
+
+    def allocate_many(self, count):
+        if count > self.free:
+            raise PriorityRangeExhaustedError(f"Requested {count} priorities but only {self.free} are free in range {self.priority_range[0]}-{self.priority_range[1]}")
+        return [self.allocate() for _ in range(count)]
+
+    def allocate_hashed(self, key, indexes):
+        """Take one priority per index by hashing `key` and the index into the range and probing forward from there.
+
+        The same key, indexes and occupancy always give the same priorities.
+        """
+        indexes = list(indexes)
+        if len(indexes) > self.free:
+            raise PriorityRangeExhaustedError(f"Requested {len(indexes)} priorities but only {self.free} are free in range {self.priority_range[0]}-{self.priority_range[1]}")
+        return [self.allocate(hash_priority(key, index, self.priority_range)) for index in indexes]
+
+    def allocate_block(self, count, target=None):
+        """Take a run of `count` consecutive free priorities from the smallest interval that fits it.
+
+        With `target` the run is instead the first one that fits at or after `target`, wrapping
+        around to the start of the range.
+        """
+        if target is None:
+            return self.allocate_blocks([count])[0]
+
+        index = bisect.bisect_right(self._starts, target) - 1
+        intervals = len(self._starts)
+        candidates = ((position % intervals, self._starts[position % intervals]) for position in range(index + 1, index + 1 + intervals))
+        if index >= 0 and target <= self._ends[index]:
+            candidates = itertools.chain([(index, target)], candidates)
+        for index, start in candidates:
+            if self._ends[index] - start + 1 >= count:
+                self._take(index, start, count)
+                return list(range(start, start + count))
+
+        largest = max((end - start + 1 for start, end in zip(self._starts, self._ends)), default=0)
+        raise PriorityRangeExhaustedError(f"No run of {count} consecutive free priorities in range {self.priority_range[0]}-{self.priority_range[1]} (largest is {largest})")
+
+    def allocate_blocks(self, counts):
+        """Take a run of consecutive free priorities for each of `counts`, placing the largest first.
+
+        The free intervals are sorted by length once for the whole batch and each block takes the
+        smallest interval that fits it, so many blocks cost one sort plus a binary search each.
+        """
+        extents = sorted((end - start + 1, start) for start, end in zip(self._starts, self._ends))
+        blocks = [None] * len(counts)
+        for position in sorted(range(len(counts)), key=lambda i: -counts[i]):
+            count = counts[position]
+            index = bisect.bisect_left(extents, (count,))
+            if index == len(extents):
+                largest = extents[-1][0] if extents else 0
+                raise PriorityRangeExhaustedError(f"No run of {count} consecutive free priorities in range {self.priority_range[0]}-{self.priority_range[1]} (largest is {largest})")
+            length, start = extents.pop(index)
+            if length > count:
+                bisect.insort(extents, (length - count, start + count))
+            blocks[position] = list(range(start, start + count))
+
+        extents.sort(key=lambda extent: extent[1])
+        self._starts = [start for _, start in extents]
+        self._ends = [start + length - 1 for length, start in extents]
+        self.free -= sum(counts)
+        return blocks
+
+    def _take(self, index, priority, count=1):
+        start, end = self._starts[index], self._ends[index]
+        last = priority + count - 1
+        if start == priority and end == last:
+            del self._starts[index]
+            del self._ends[index]
+        elif priority == start:
+            self._starts[index] = last + 1
+        elif last == end:
+            self._ends[index] = priority - 1
+        else:
+            self._ends[index] = priority - 1
+            self._starts.insert(index + 1, last + 1)
+            self._ends.insert(index + 1, end)
+        self.free -= count
+
+
+def resolve_rule_priority(anchor):
+    """Return the priority of a Before/After anchor, given either as a priority or as a rule ARN."""
+    if str(anchor).isdecimal():
+        return int(anchor)
+    rules = call_elbv2(get_elbv2_client().describe_rules, RuleArns=[anchor])['Rules']
+    if not rules or not rules[0]['Priority'].isdecimal():
+        raise ValueError(f"Rule {anchor} has no numeric priority to order against")
+    return int(rules[0]['Priority'])
+
+
+def get_priority_gap(occupancy, before=None, after=None):
+    """Return the exclusive bounds (low, high) of the run of free priorities just before `before` or just after `after`."""
+    if after is not None:
+        high = occupancy.find(1, after + 1, ALB_MAX_PRIORITY + 1)
+        return after, ALB_MAX_PRIORITY + 1 if high == -1 else high
+    low = occupancy.rfind(1, 1, before)
+    return 0 if low == -1 else low, before
+
+
+def spread_in_gap(low, high, count):
+    """Return `count` priorities spaced evenly between `low` and `high`, leaving room on both sides for later inserts."""
+    size = high - low - 1
+    if count > size:
+        raise PriorityRangeExhaustedError(f"Only {size} free priorities between {low} and {high}, {count} needed")
+    return [low + (i + 1) * (high - low) // (count + 1) for i in range(count)]
+
+
+def _push_rules(occupancy, rule_arns, start, step, need):
+    """Walk from `start` in direction `step` until `need` free priorities are passed.
+
+    Returns the rules passed on the way and the last position, or None when the walk leaves the
+    priority space or meets a priority that is reserved but has no rule yet and so cannot be moved.
+    """
+    stretch = []
+    position = start - step
+    while need:
+        position += step
+        if not 1 <= position <= ALB_MAX_PRIORITY:
+            return None
+        if not occupancy[position]:
+            need -= 1
+        elif position in rule_arns:
+            stretch.append(position)
+        else:
+            return None
+    return stretch, position
+
+
+def rebalance_gap(listener_arn, occupancy, low, high, count, owner):
+    """Make room for `count` priorities between `low` and `high` by moving the fewest neighbouring rules, and return them.
+
+    The rules just above the gap are pushed up, or the rules just below it down, whichever moves
+    fewer rules, in a single set_rule_priorities call. The rules keep their order, so the new
+    priorities still sit between the same two rules. When a reservation backend is configured the
+    priorities the rules move to are claimed for `owner` during the move, so no other container
+    hands them out meanwhile.
+    """
+    elbv2_client = get_elbv2_client()
+    rule_arns = {int(rule['Priority']): rule['RuleArn'] for rule in iter_rules(elbv2_client, listener_arn) if rule['Priority'].isdecimal()}
+    need = count - (high - low - 1)
+
+    candidates = []
+    up = _push_rules(occupancy, rule_arns, high, 1, need)
+    if up:
+        stretch, end = up
+        moved_to = end - len(stretch) + 1
+        candidates.append((stretch, range(moved_to, end + 1), [*range(low + 1, moved_to)]))
+    down = _push_rules(occupancy, rule_arns, low, -1, need)
+    if down:
+        stretch, end = down
+        stretch.reverse()
+        moved_to = end + len(stretch)
+        candidates.append((stretch, range(end, moved_to), [*range(moved_to, high)]))
+    if not candidates:
+        raise PriorityRangeExhaustedError(f"No room to rebalance {count} priorities between {low} and {high} on {listener_arn}")
+
+    stretch, targets, priorities = min(candidates, key=lambda candidate: len(candidate[0]))
+    moves = [(old, new) for old, new in zip(stretch, targets) if old != new]
+    destinations = [new for _, new in moves if new not in stretch]
+    backend = get_reservation_backend()
+    if backend:
+        claimed = backend.claim(listener_arn, destinations, owner)
+        if len(claimed) < len(destinations):
+            backend.release(listener_arn, claimed, owner)
+            raise PriorityRangeExhaustedError(f"Priorities needed to rebalance between {low} and {high} on {listener_arn} are reserved by another allocation")
+    logger.warning("Moving %d rules on %s to make room between priorities %d and %d", len(moves), listener_arn, low, high)
+    try:
+        call_elbv2(elbv2_client.set_rule_priorities, RulePriorities=[{'RuleArn': rule_arns[old], 'Priority': new} for old, new in moves])
+    finally:
+        # Once moved the rules hold the priorities themselves
+        if backend:
+            backend.release(listener_arn, destinations, owner)
+    put_metric('RulesRebalanced', len(moves))
+    for old, _ in moves:
+        occupancy[old] = 0
+    for _, new in moves:
+        occupancy[new] = 1
+    return priorities
+
+
+def take_in_gap(listener_arn, occupancy, count, anchor, owner, rebalance=False):
+    """Take `count` priorities from the gap next to an anchor, rebalancing the listener if allowed and needed."""
+    low, high = get_priority_gap(occupancy, **anchor)
+    try:
+        return spread_in_gap(low, high, count)
+    except PriorityRangeExhaustedError:
+        if not rebalance:
+            raise
+    return rebalance_gap(listener_arn, occupancy, low, high, count, owner)
+
+
+def get_alb_rule_priorities(listener_arn, count, owner=None, contiguous=False, priority_range=ALB_RULE_PRIORITY_RANGE, exclude=(),
+                            before=None, after=None, rebalance=False, strategy=None):
+    """Allocate `count` unused priorities in `priority_range` on a listener from a single describe_rules snapshot.
+
+    With `contiguous` the priorities are one run of consecutive values, and priorities in
+    `exclude` are treated as taken even if the listener has no rule for them yet. With `before` or
+    `after` (a rule ARN or priority) the priorities are instead spread over the free gap next to
+    that rule, whatever the range; when the gap is too small they fail, or with `rebalance` the
+    neighbouring rules are moved to widen it. `contiguous` cannot be combined with them. When a reservation backend is configured every
+    priority is also claimed there for `owner`, and priorities that another container claimed first
+    are replaced from the same snapshot.
+
+    `strategy` (ALLOCATION_STRATEGY by default) is "random", or "hashed" to start from a hash of
+    `owner` and probe forward to the next free priority, so a retry by the same owner against the
+    same rules gets the same priorities and different owners rarely pick the same ones.
+    """
+    if before is not None and after is not None:
+        raise ValueError("Before and After cannot both be set")
+    if contiguous and (before is not None or after is not None):
+        raise ValueError("Contiguous cannot be combined with Before or After, which spread the priorities over the gap")
+    strategy = (strategy or ALLOCATION_STRATEGY).lower()
+    if strategy not in ALLOCATION_STRATEGIES:
+        raise ValueError(f"AllocationStrategy must be one of {', '.join(ALLOCATION_STRATEGIES)}, got {strategy!r}")
+    owner = owner or str(uuid.uuid4())
+    anchor = {key: resolve_rule_priority(value) for key, value in (('before', before), ('after', after)) if value is not None}
+    occupancy = get_rule_snapshot(listener_arn)
+    # Allocations on one listener share its snapshot, so they take turns marking it
+    with get_listener_lock(listener_arn):
+        for priority in [*get_reserved_priorities(listener_arn), *exclude]:
+            occupancy[int(priority)] = 1
+
+        started = time.monotonic()
+        candidates = occupancy
+        if strategy == 'hashed':
+            # The owner's own earlier priorities count as free, so a retry lands on them again
+            candidates = bytearray(occupancy)
+            for priority in get_reserved_priorities(listener_arn, owner):
+                candidates[priority] = 0
+            for priority in exclude:
+                candidates[int(priority)] = 1
+        allocator = PriorityAllocator(candidates, priority_range)
+        logger.info("Priority range %d-%d on %s is %.2f%% used (%d free)", *allocator.priority_range, listener_arn, allocator.utilisation * 100, allocator.free)
+        put_metric('RangeUtilisation', allocator.utilisation * 100, 'Percent')
+        probes = itertools.count()
+        if anchor:
+            take = lambda n: take_in_gap(listener_arn, occupancy, n, anchor, owner, rebalance)
+        elif strategy == 'hashed' and contiguous:
+            take = lambda n: allocator.allocate_block(n, hash_priority(owner, next(probes), priority_range))
+        elif strategy == 'hashed':
+            take = lambda n: allocator.allocate_hashed(owner, [next(probes) for _ in range(n)])
+        else:
+            take = allocator.allocate_block if contiguous else allocator.allocate_many
+
+        backend = get_reservation_backend()
+        allocated = []
+        pending = take(count)
+        for attempt in range(1, RESERVATION_MAX_ATTEMPTS + 1):
+            for priority in pending:
+                occupancy[priority] = 1
+            claimed = set(backend.claim(listener_arn, pending, owner)) if backend else set(pending)
+            if contiguous and len(claimed) < len(pending):
+                # A block is only useful whole, so give back the part we did get
+                backend.release(listener_arn, list(claimed), owner)
+                for priority in claimed:
+                    occupancy[priority] = 0
+                claimed = set()
+            allocated.extend(priority for priority in pending if priority in claimed)
+            lost = len(pending) - len(claimed)
+            if not lost:
+                break
+            put_metric('ReservationCollisions', lost)
+            if attempt == RESERVATION_MAX_ATTEMPTS:
+                backend.release(listener_arn, allocated, owner)
+                raise RuntimeError(f"Could not reserve {count} priorities on {listener_arn} after {attempt} attempts")
+            logger.warning("%d priorities were already reserved by another allocation, retrying (attempt %d)", lost, attempt)
+            pending = take(lost)
+
+        reserve_priorities(listener_arn, allocated, owner)
+    _INVOCATION_ALLOCATIONS.append((listener_arn, allocated, owner))
+    priorities = [str(priority) for priority in allocated]
+    put_metric('AllocationTime', (time.monotonic() - started) * 1000, 'Milliseconds')
+    put_metric('PrioritiesAllocated', len(priorities))
+    return priorities
+
+
+def get_alb_rule_priorities_for_listeners(listener_arns, count, owner=None, **kwargs):
+    """Allocate `count` priorities on each listener, reading the listeners concurrently with the shared client.
+
+    Returns a dict of listener ARN to its priorities; keyword arguments are passed on to
+    get_alb_rule_priorities for every listener.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    listener_arns = list(dict.fromkeys(listener_arns))
+    get_elbv2_client()
+    with ThreadPoolExecutor(max_workers=max(1, min(LISTENER_CONCURRENCY, len(listener_arns)))) as executor:
+        futures = {listener_arn: executor.submit(get_alb_rule_priorities, listener_arn, count, owner, **kwargs) for listener_arn in listener_arns}
+        return {listener_arn: future.result() for listener_arn, future in futures.items()}
+
+
+def analyze_listener(listener_arn, priority_range=ALB_RULE_PRIORITY_RANGE, allocations_per_day=None, top=5):
+    """Report how full and how fragmented a listener's priority range is, from a fresh describe_rules read.
+
+    Fragmentation is 1 - largest free extent / free priorities: 0 when all free priorities are one
+    run, approaching 1 as they scatter into single gaps. With `allocations_per_day` the headroom is
+    the number of days until the range is full at that rate. `top` only limits how many of the
+    largest free extents are listed.
+    """
+    if top < 0:
+        raise ValueError(f"Top must not be negative, got {top}")
+    allocator = PriorityAllocator(get_rule_snapshot(listener_arn, force_refresh=True), priority_range)
+    extents = allocator.extents()
+    largest = sorted(extents, key=lambda extent: extent[1] - extent[0], reverse=True)
+    largest_length = largest[0][1] - largest[0][0] + 1 if largest else 0
+    return {
+        'PriorityRange': f"{allocator.priority_range[0]}-{allocator.priority_range[1]}",
+        'Used': allocator.used,
+        'Free': allocator.free,
+        'Utilisation': round(allocator.utilisation, 4),
+        'FreeExtents': len(extents),
+        'LargestFreeExtents': [{'Start': start, 'End': end, 'Length': end - start + 1} for start, end in largest[:top]],
+        'Fragmentation': round(1 - largest_length / allocator.free, 4) if allocator.free else 0,
+        'HeadroomDays': round(allocator.free / allocations_per_day, 1) if allocations_per_day else None,
+    }
+
+
+def analyze_listeners(event):
+    """Handle a direct {"Action": "AnalyzeListeners"} invocation with analytics for each of its ListenerArns.
+
+    The event may also set PriorityRange (the default range otherwise), AllocationsPerDay for the
+    headroom projection, and Top for the number of largest free extents to list. Listeners are
+    read concurrently; a listener that cannot be read reports its error instead.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    listener_arns = list(dict.fromkeys(get_request_listener_arns(event) or [event['ListenerArn']]))
+    priority_range = parse_priority_range(event['PriorityRange']) if event.get('PriorityRange') else ALB_RULE_PRIORITY_RANGE
+    allocations_per_day = float(event['AllocationsPerDay']) if event.get('AllocationsPerDay') else None
+    top = int(event.get('Top', 5))
+    if top < 0:
+        raise ValueError(f"Top must not be negative, got {top}")
+
+    get_elbv2_client()
+    listeners = {}
+    with ThreadPoolExecutor(max_workers=min(LISTENER_CONCURRENCY, len(listener_arns))) as executor:
+        futures = {arn: executor.submit(analyze_listener, arn, priority_range, allocations_per_day, top) for arn in listener_arns}
+        for listener_arn, future in futures.items():
+            try:
+                listeners[listener_arn] = future.result()
+            except Exception as e:
+                logger.exception("Could not analyze %s", listener_arn)
+                listeners[listener_arn] = {'Error': str(e)}
+    return {'Listeners': listeners}
+
+
+def encode_physical_resource_id(resource_id, priority_sets):
+    """Build a PhysicalResourceId that carries the allocated priorities, one set per listener.
+
+    The format is "<resource id>:<p1>,<p2>;<q1>,<q2>". If that would exceed the CloudFormation
+    limit the plain resource id is returned and later Updates reallocate.
+    """
+    physical_resource_id = f"{resource_id}:{';'.join(','.join(priorities) for priorities in priority_sets)}"
+    if len(physical_resource_id) > PHYSICAL_RESOURCE_ID_MAX_LENGTH:
+        logger.warning("Allocated priorities do not fit in the PhysicalResourceId, Updates will reallocate")
+        return resource_id
+    return physical_resource_id
+
+
+def decode_physical_resource_id(physical_resource_id):
+    """Split a PhysicalResourceId into its resource id and priority sets (None if it carries none)."""
+    match = re.fullmatch(r'([^:]+):(\d+(?:,\d+)*(?:;\d+(?:,\d+)*)*)', physical_resource_id or '')
+    if not match:
+        return physical_resource_id, None
+    return match.group(1), [priorities.split(',') for priorities in match.group(2).split(';')]
+
+
+def get_update_priorities(event, listener_arns, previous, count, owner, contiguous=False, priority_range=ALB_RULE_PRIORITY_RANGE):
+    """Return the priority sets an Update can keep from its previous allocation, or None to allocate afresh.
+
+    When nothing but PriorityCount may have changed, the previous priorities are returned as they
+    are, trimmed to the new count, or topped up with newly allocated priorities on each listener.
+    """
+    if previous is None or len(previous) != len(listener_arns):
+        return None
+
+    old_properties = {k: v for k, v in event.get('OldResourceProperties', {}).items() if k not in UPDATE_IGNORED_PROPERTIES}
+    new_properties = {k: v for k, v in event.get('ResourceProperties', {}).items() if k not in UPDATE_IGNORED_PROPERTIES}
+    old_count = int(old_properties.pop('PriorityCount', None) or 1)
+    new_properties.pop('PriorityCount', None)
+    if old_properties != new_properties or any(len(priorities) != old_count for priorities in previous):
+        return None
+
+    if count == old_count:
+        logger.info("Allocation properties unchanged, keeping priorities %s", previous)
+        return previous
+    if contiguous:
+        return None
+    if count < old_count:
+        logger.info("Shrinking allocation from %d to %d priorities per listener", old_count, count)
+        return [sorted(priorities, key=int)[:count] for priorities in previous]
+
+    logger.info("Growing allocation from %d to %d priorities per listener", old_count, count)
+    return [
+        priorities + get_alb_rule_priorities(listener_arn, count - old_count, owner, priority_range=priority_range, exclude=priorities,
+                                             **get_request_options(event.get('ResourceProperties', {})))
+        for listener_arn, priorities in zip(listener_arns, previous)
+    ]
+
+
+def verify_priorities(listener_arns, priority_sets, kept_sets, owner, deadline, contiguous=False, **kwargs):
+    """Re-read the listeners just before responding and replace new priorities that another rule has taken since.
+
+    describe_rules has no change feed, so each listener is read again in full, but only the
+    priorities that collide are reallocated (a contiguous block moves whole) and the replacements
+    are checked again. Verification stops at `deadline` (a time.monotonic value) and the current
+    priorities are returned as they are. Priorities in `kept_sets` were allocated earlier and are
+    not checked. Keyword arguments are passed on to get_alb_rule_priorities.
+    """
+    priority_sets = [list(priorities) for priorities in priority_sets]
+    for position, listener_arn in enumerate(listener_arns):
+        pending = [priority for priority in priority_sets[position] if priority not in kept_sets[position]]
+        while pending:
+            if time.monotonic() >= deadline:
+                logger.warning("Verification time budget spent, responding with unverified priorities on %s", listener_arn)
+                return priority_sets
+
+            with timed('VerificationTime'):
+                occupancy = get_rule_snapshot(listener_arn, force_refresh=True)
+            conflicts = [priority for priority in pending if occupancy[int(priority)]]
+            if not conflicts:
+                break
+
+            put_metric('VerificationConflicts', len(conflicts))
+            logger.warning("Priorities %s on %s were taken after allocation, replacing them", conflicts, listener_arn)
+            release_priorities(listener_arn, conflicts, owner)
+            if contiguous:
+                # A block is only useful whole, so the rest of it goes back too
+                release_priorities(listener_arn, [priority for priority in pending if priority not in conflicts], owner, unused=True)
+                conflicts = pending
+            remaining = [priority for priority in priority_sets[position] if priority not in conflicts]
+            pending = get_alb_rule_priorities(listener_arn, len(conflicts), owner, contiguous=contiguous, exclude=remaining, **kwargs)
+            priority_sets[position] = remaining + pending
+    return priority_sets
+
+
+def get_request_options(request_properties):
+    """Return the Before, After, Rebalance and AllocationStrategy properties as keyword arguments for get_alb_rule_priorities.
+
+    Properties that are not set are left out, so the allocator's defaults apply.
+    """
+    options = {key.lower(): request_properties[key] for key in ('Before', 'After') if request_properties.get(key)}
+    if options and str(request_properties.get('Rebalance', 'false')).lower() == 'true':
+        options['rebalance'] = True
+    if request_properties.get('AllocationStrategy'):
+        options['strategy'] = request_properties['AllocationStrategy']
+    return options
+
+
+def get_request_listener_arns(request_properties):
+    """Return the ListenerArns property as a list, accepting a list or a comma-separated string."""
+    listener_arns = request_properties.get('ListenerArns')
+    if isinstance(listener_arns, str):
+        listener_arns = [arn.strip() for arn in listener_arns.split(',') if arn.strip()]
+    return listener_arns
+
+
+def build_response_data(listener_arns, priority_sets, multiple_listeners, with_count):
+    response_data = {}
+    if multiple_listeners:
+        for i, priorities in enumerate(priority_sets):
+            if with_count:
+                response_data[f'Priorities{i}'] = ",".join(priorities)
+            else:
+                response_data[f'Priority{i}'] = priorities[0]
+        response_data['ListenerArns'] = ",".join(listener_arns)
+    else:
+        if with_count:
+            response_data['Priorities'] = ",".join(priority_sets[0])
+        else:
+            response_data['Priority'] = priority_sets[0][0]
+        response_data['ListenerArn'] = listener_arns[0]
+    return response_data
+
+
+def _lambda_handler(event, context, respond=None):
     """Process CloudFormation custom resource events for ALB rule priority allocation.
 
     This Lambda handler manages the allocation of Application Load Balancer (ALB) rule priorities
@@ -49,9 +1259,20 @@ def _lambda_handler(event, context):
             - RequestType: Create, Update or Delete
             - ResourceProperties: Dictionary containing:
                 - ListenerArn: ARN of the ALB listener
+                - ListenerArns: List of listener ARNs to allocate on, instead of ListenerArn (optional)
                 - PriorityCount: Number of priorities to allocate (optional)
-            - PhysicalResourceId: Resource identifier (optional)
+                - Contiguous: "true" to allocate the PriorityCount priorities as one consecutive run (optional)
+                - PriorityRange: "low-high" range to allocate from instead of ALB_RULE_PRIORITY_RANGE (optional)
+                - ShardCount: Split the range into this many shards and allocate from one (optional)
+                - ShardKey: Key that picks the shard, defaults to the StackId (optional)
+                - Before / After: Rule ARN or priority to place the priorities just before or after (optional)
+                - Rebalance: "true" to move neighbouring rules when the gap next to Before/After is full (optional)
+                - AllocationStrategy: "Random", or "Hashed" for priorities derived from the StackId and LogicalResourceId (optional)
+                - Verify: "true" to re-read the listeners before responding and replace priorities taken meanwhile (optional)
+            - PhysicalResourceId: Resource identifier carrying the previous priorities (Update and Delete)
+            - OldResourceProperties: Previous properties (Update)
         context (LambdaContext): AWS Lambda context object
+        respond (callable): Called with send's arguments to deliver the response, send by default
 
     Returns:
         dict: CloudFormation custom resource response containing:
@@ -59,57 +1280,114 @@ def _lambda_handler(event, context):
             - Data: Dictionary containing allocated priorities:
                 - If PriorityCount specified: {'Priorities': "comma,separated,list", 'ListenerArn': listener_arn}
                 - If no count specified: {'Priority': priority, 'ListenerArn': listener_arn}
-            - PhysicalResourceId: Resource identifier
+                - If ListenerArns specified: {'Priorities0': "list", 'Priorities1': ..., 'ListenerArns': "comma,separated,list"},
+                  or 'Priority0', 'Priority1', ... when no count is specified
+            - PhysicalResourceId: "<resource id>:<priorities>", see encode_physical_resource_id. An Update
+              that only changes PriorityCount, or nothing at all, keeps the previous priorities.
 
     Raises:
         None: Failures are handled by returning FAILED status to CloudFormation
     """
-    print("Received event: " + json.dumps(event, indent=2))
+    respond = respond or send
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received event: %s", json.dumps(event))
 
     physical_resource_id = event.get('PhysicalResourceId', str(uuid.uuid4()))
     response_data = {}
 
     request_type = event['RequestType']
-    print(f"Request type is {request_type}")
-    print(f"Allocation cache state: {ALLOCATING}")
+    logger.info("Request type is %s", request_type)
 
     request_properties = event.get('ResourceProperties', {})
+    owner = f"{event['StackId']}/{event['LogicalResourceId']}"
 
     if request_type in ['Create', 'Update']:
         listener_arn = request_properties.get('ListenerArn')
         request_priority_count = request_properties.get('PriorityCount')
-        print(request_properties, listener_arn, request_priority_count)
-
-        if listener_arn and request_priority_count:
-            print(f"Allocating {request_priority_count} priorities for {listener_arn}")
-            priorities = []
-            response_data['Priorities'] = ""
-            for _ in range(int(request_priority_count)):
-                priority = get_alb_rule_priority(listener_arn)
-                priorities.append(priority)
-            priorities.sort()
-            response_data['Priorities'] = ",".join(priorities)
-            response_data['ListenerArn'] = listener_arn
-            print(f"Allocated priorities: {response_data['Priorities']}")
-            return send(event, context, SUCCESS, response_data, physical_resource_id)
-        elif listener_arn:
-            print("No priority count specified, allocating one")
-            priority = get_alb_rule_priority(listener_arn)
-            response_data['Priority'] = priority
-            response_data['ListenerArn'] = listener_arn
-            print(f"Allocated: {response_data}")
-            return send(event, context, SUCCESS, response_data, physical_resource_id)
+        contiguous = str(request_properties.get('Contiguous', 'false')).lower() == 'true'
+        priority_range = get_request_priority_range(request_properties, event)
+        options = get_request_options(request_properties)
+
+        listener_arns = get_request_listener_arns(request_properties)
+
+        if listener_arns or listener_arn:
+            listeners = listener_arns or [listener_arn]
+            count = int(request_priority_count or 1)
+            resource_id, previous = decode_physical_resource_id(event.get('PhysicalResourceId'))
+
+            priority_sets = None
+            if request_type == 'Update':
+                priority_sets = get_update_priorities(event, listeners, previous, count, owner, contiguous=contiguous, priority_range=priority_range)
+            # Priorities kept from the previous allocation may already have rules, so only new ones are verified
+            kept_sets = previous if priority_sets is not None else [[] for _ in listeners]
+
+            if priority_sets is None:
+                if listener_arns:
+                    logger.info("Allocating %d %spriorities on each of %d listeners", count, 'contiguous ' if contiguous else '', len(listener_arns))
+                    allocations = get_alb_rule_priorities_for_listeners(listener_arns, count, owner, contiguous=contiguous, priority_range=priority_range, **options)
+                    priority_sets = [allocations[arn] for arn in listener_arns]
+                elif request_priority_count:
+                    logger.info("Allocating %s %spriorities for %s", request_priority_count, 'contiguous ' if contiguous else '', listener_arn)
+                    priority_sets = [get_alb_rule_priorities(listener_arn, count, owner, contiguous=contiguous, priority_range=priority_range, **options)]
+                else:
+                    logger.info("No priority count specified, allocating one")
+                    priority_sets = [[get_alb_rule_priority(listener_arn, owner, priority_range=priority_range, **options)]]
+
+            if str(request_properties.get('Verify', VERIFY_ALLOCATIONS)).lower() == 'true':
+                deadline = time.monotonic() + min(VERIFY_TIME_BUDGET, context.get_remaining_time_in_millis() / 1000 - SEND_CONNECT_TIMEOUT - SEND_READ_TIMEOUT)
+                priority_sets = verify_priorities(listeners, priority_sets, kept_sets, owner, deadline, contiguous=contiguous, priority_range=priority_range, **options)
+
+            priority_sets = [sorted(priorities, key=int) for priorities in priority_sets]
+            response_data = build_response_data(listeners, priority_sets, bool(listener_arns), bool(request_priority_count))
+            physical_resource_id = encode_physical_resource_id(resource_id or physical_resource_id, priority_sets)
+            if request_type == 'Update' and physical_resource_id != event['PhysicalResourceId']:
+                # CloudFormation deletes the old id next; tag what this resource holds so that Delete keeps it
+                for listener, priorities in zip(listeners, priority_sets):
+                    hold_priorities(listener, priorities, owner, physical_resource_id)
+            logger.info("Allocated: %s", response_data)
+            return respond(event, context, SUCCESS, response_data, physical_resource_id)
 
     if request_type == 'Delete':
-        return send(event, context, SUCCESS, request_properties, physical_resource_id)
+        _, previous = decode_physical_resource_id(physical_resource_id)
+        if previous:
+            listeners = get_request_listener_arns(request_properties) or [request_properties.get('ListenerArn')]
+            for listener_arn, priorities in zip(listeners, previous):
+                if listener_arn:
+                    release_priorities(listener_arn, priorities, owner, physical_resource_id=physical_resource_id)
+        return respond(event, context, SUCCESS, request_properties, physical_resource_id)
+
+    return respond(event, context, FAILED, response_data, physical_resource_id, reason='No response data')
 
-    return send(event, context, FAILED, response_data, physical_resource_id, reason='No response data')
+
+def _get_connection(parsed_url):
+    """Return this thread's open connection to the response host, connecting it if needed."""
+    connections = _HTTP.__dict__.setdefault('connections', {})
+    key = (parsed_url.scheme, parsed_url.netloc)
+    conn = connections.get(key)
+    if conn is None:
+        connection_class = http.client.HTTPConnection if parsed_url.scheme == 'http' else http.client.HTTPSConnection
+        conn = connections[key] = connection_class(parsed_url.netloc, timeout=SEND_CONNECT_TIMEOUT)
+    if conn.sock is None:
+        conn.connect()
+        conn.sock.settimeout(SEND_READ_TIMEOUT)
+    return conn
+
+
+def _drop_connection(parsed_url):
+    conn = _HTTP.__dict__.get('connections', {}).pop((parsed_url.scheme, parsed_url.netloc), None)
+    if conn is not None:
+        conn.close()
 
 
 def send(event, context, response_status, response_data, physical_resource_id, reason=None):
+    """PUT the custom resource response to the pre-signed ResponseURL.
+
+    Connection errors, 429 and 5xx responses are retried with jittered exponential backoff for up
+    to SEND_MAX_ATTEMPTS attempts, as long as another attempt fits in the invocation's remaining
+    time. Returns the last HTTP status, or None if no response was received.
+    """
     response_url = event['ResponseURL']
     parsed_url = urlparse(response_url)
-    conn = http.client.HTTPSConnection(parsed_url.netloc)
 
     response_body = {
         'Status': response_status,
@@ -122,9 +1400,155 @@ def send(event, context, response_status, response_data, physical_resource_id, r
     }
 
     json_response_body = json.dumps(response_body)
-    conn.request('PUT', f"{parsed_url.path}?{parsed_url.query}", body=json_response_body, headers={'Content-Length': str(len(json_response_body))})
+    status = None
+    for attempt in range(1, SEND_MAX_ATTEMPTS + 1):
+        started = time.monotonic()
+        try:
+            conn = _get_connection(parsed_url)
+            conn.request('PUT', f"{parsed_url.path}?{parsed_url.query}", body=json_response_body, headers={'Content-Length': str(len(json_response_body))})
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            _drop_connection(parsed_url)
+            logger.warning("Failed to send message to CloudFormation: %r (attempt %d)", e, attempt)
+        else:
+            status = response.status
+            latency_ms = (time.monotonic() - started) * 1000
+            put_metric('SendTime', latency_ms, 'Milliseconds')
+            if status == 200:
+                logger.info("Sent %s response to CloudFormation in %.0f ms (attempt %d)", response_status, latency_ms, attempt)
+                return status
+            logger.warning("Failed to send message to CloudFormation. HTTP status code: %d", status)
+            logger.warning("Response: %s", body.decode())
+            if status < 500 and status != 429:
+                return status
+
+        delay = random.uniform(0, min(SEND_BACKOFF_CAP, SEND_BACKOFF_BASE * 2 ** (attempt - 1)))
+        remaining = context.get_remaining_time_in_millis() / 1000
+        if attempt == SEND_MAX_ATTEMPTS or delay + SEND_CONNECT_TIMEOUT + SEND_READ_TIMEOUT > remaining:
+            break
+        put_metric('SendRetries', 1)
+        time.sleep(delay)
+
+    logger.error("Giving up sending %s response to CloudFormation after %d attempts", response_status, attempt)
+    return status
+
+
+def listener_arn_from_rule_arn(rule_arn):
+    """Return the ARN of the listener a rule belongs to.
+
+    arn:...:listener-rule/app/<lb>/<lb id>/<listener id>/<rule id> becomes
+    arn:...:listener/app/<lb>/<lb id>/<listener id>.
+    """
+    prefix, separator, path = rule_arn.partition(':listener-rule/')
+    if not separator or '/' not in path:
+        raise ValueError(f"Not a listener rule ARN: {rule_arn!r}")
+    return f"{prefix}:listener/{path.rsplit('/', 1)[0]}"
+
+
+def load_rule_exports(exports):
+    """Build listener occupancies from exported `aws elbv2 describe-rules` documents.
+
+    Rules are grouped by the listener in their RuleArn, so one export may hold several listeners
+    and one listener may be split over several exports (one per page, say).
+    """
+    occupancies = {}
+    for export in exports:
+        for rule in export['Rules']:
+            occupancy = occupancies.setdefault(listener_arn_from_rule_arn(rule['RuleArn']), bytearray(ALB_MAX_PRIORITY + 1))
+            if rule['Priority'].isdecimal():
+                occupancy[int(rule['Priority'])] = 1
+    return occupancies
+
+
+def plan_priorities(occupancies, manifest):
+    """Allocate priorities for every manifest entry at once and return one list of priority sets per entry.
+
+    Entries take the custom resource's properties (ListenerArn or ListenerArns, PriorityCount,
+    Contiguous, PriorityRange, ShardCount, ShardKey) plus a StackName that stands in for the
+    StackId as the default shard key. Requests are grouped by listener and range, and each group
+    builds one PriorityAllocator and places all of its contiguous blocks in one batch before
+    single priorities fragment the range. The occupancies are updated with the plan.
+    """
+    groups = {}
+    plan = []
+    for position, entry in enumerate(manifest):
+        listener_arns = get_request_listener_arns(entry) or [entry.get('ListenerArn')]
+        if not listener_arns[0]:
+            raise ValueError(f"Manifest entry for {entry['StackName']} has no ListenerArn or ListenerArns")
+        priority_range = get_request_priority_range(entry, {'StackId': entry['StackName']})
+        contiguous = str(entry.get('Contiguous', 'false')).lower() == 'true'
+        count = int(entry.get('PriorityCount') or 1)
+        for listener_index, listener_arn in enumerate(listener_arns):
+            if listener_arn not in occupancies:
+                raise ValueError(f"No describe-rules export for listener {listener_arn!r} needed by {entry['StackName']}")
+            blocks, scattered = groups.setdefault((listener_arn, priority_range), ([], []))
+            (blocks if contiguous else scattered).append((count, position, listener_index))
+        plan.append([None] * len(listener_arns))
+
+    for (listener_arn, priority_range), (blocks, scattered) in groups.items():
+        occupancy = occupancies[listener_arn]
+        allocator = PriorityAllocator(occupancy, priority_range)
+        allocated = list(zip(blocks, allocator.allocate_blocks([count for count, _, _ in blocks])))
+        allocated += [(request, allocator.allocate_many(request[0])) for request in scattered]
+        for (_, position, listener_index), priorities in allocated:
+            # Later groups on the same listener may overlap this range
+            for priority in priorities:
+                occupancy[priority] = 1
+            plan[position][listener_index] = [str(priority) for priority in sorted(priorities)]
+    return plan
+
+
+def format_plan(manifest, plan, output_format='json'):
+    """Render a plan as the custom resource's response attributes per entry, or as CloudFormation parameters per stack.
+
+    Parameter keys are the attribute names (Priority, Priorities, Priority0, ...), prefixed with
+    the entry's LogicalResourceId when it has one so several entries can share a stack.
+    """
+    attributes = []
+    parameters = {}
+    for entry, priority_sets in zip(manifest, plan):
+        listener_arns = get_request_listener_arns(entry)
+        response_data = build_response_data(listener_arns or [entry['ListenerArn']], priority_sets, bool(listener_arns), bool(entry.get('PriorityCount')))
+        resource = {key: entry[key] for key in ('StackName', 'LogicalResourceId') if entry.get(key)}
+        attributes.append({**resource, **response_data})
+        parameters.setdefault(entry['StackName'], []).extend(
+            {'ParameterKey': f"{resource.get('LogicalResourceId', '')}{key}", 'ParameterValue': value}
+            for key, value in response_data.items() if key not in ('ListenerArn', 'ListenerArns')
+        )
+    return attributes if output_format == 'json' else parameters
+
+
+def main(argv=None):
+    """Plan priorities for a fleet of stacks offline, from describe-rules exports and a manifest."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--rules', nargs='+', required=True, metavar='FILE', help='output of `aws elbv2 describe-rules --output json`, one or more files')
+    parser.add_argument('--manifest', required=True, metavar='FILE', help='JSON list of {"StackName": ..., "ListenerArn": ..., "PriorityCount": ...} entries')
+    parser.add_argument('--format', choices=('json', 'parameters'), default='json', help='custom resource attributes per entry, or CloudFormation parameters per stack')
+    parser.add_argument('--seed', type=int, help='seed the random allocation for a reproducible plan')
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(message)s')
+
+    exports = []
+    for path in args.rules:
+        with open(path) as f:
+            exports.append(json.load(f))
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    started = time.perf_counter()
+    try:
+        plan = plan_priorities(load_rule_exports(exports), manifest)
+    except (ValueError, PriorityRangeExhaustedError) as e:
+        parser.exit(1, f"{parser.prog}: error: {e}\n")
+    logger.info("Planned %d requests in %.1f ms", len(manifest), (time.perf_counter() - started) * 1000)
+
+    print(json.dumps(format_plan(manifest, plan, args.format), indent=2))
+
 
-    response = conn.getresponse()
-    if response.status != 200:
-        print(f"Failed to send message to CloudFormation. HTTP status code: {response.status}")
-        print("Response: ", response.read().decode())
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,30 @@
 import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
 from unittest.mock import MagicMock, patch
 
+from src import index
+
+
+@pytest.fixture(autouse=True)
+def reset_index_state():
+    """Reset the warm-container state kept at module level in src.index between tests."""
+    index._ELBV2_CLIENT = None
+    index._RULE_SNAPSHOTS.clear()
+    index.CACHE_STATS.update(hits=0, misses=0, coalesced=0)
+    index._IN_FLIGHT.clear()
+    index._ELBV2_LIMITER = index.TokenBucket(index.ELBV2_RATE_LIMIT, index.ELBV2_BURST)
+    index._RESERVATION_BACKEND = None
+    index._RESERVATIONS.clear()
+    index._INVOCATION_ALLOCATIONS.clear()
+    index._HTTP.__dict__.clear()
+    index._METRICS.clear()
+    yield
+    for conn in index._HTTP.__dict__.get("connections", {}).values():
+        conn.close()
+
 @pytest.fixture
 def mock_context():
     """Mock AWS Lambda context object."""
@@ -12,6 +35,7 @@ def mock_context():
     context.invoked_function_arn = "arn:aws:lambda:us-east-1:123456789012:function:test-function"
     context.memory_limit_in_mb = 128
     context.aws_request_id = "test-request-id"
+    context.get_remaining_time_in_millis.return_value = 300000
     return context
 
 @pytest.fixture
@@ -117,3 +141,36 @@ def mock_http_client():
         mock_conn.getresponse.return_value = mock_response
         
         yield mock_conn
+
+@pytest.fixture
+def cfn_response_server():
+    """Local HTTP stand-in for the CloudFormation pre-signed response URL.
+
+    Responds to each PUT with the next status in `server.statuses` (200 once they run out) and
+    records the request path, body and client address in `server.requests`.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_PUT(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            self.server.requests.append({"path": self.path, "body": json.loads(body), "client": self.client_address})
+            status = self.server.statuses.pop(0) if self.server.statuses else 200
+            payload = b"" if status == 200 else b"<Error>stand-in</Error>"
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.requests = []
+    server.statuses = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/response?X-Amz-Signature=test"
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
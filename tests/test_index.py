@@ -1,10 +1,15 @@
 import json
 import random
+import subprocess
+import sys
+import threading
 import uuid
 from unittest.mock import MagicMock, patch, call
 
 import pytest
 
+from botocore.exceptions import ClientError
+
 from src import index
 
 
@@ -67,7 +72,8 @@ class TestInternalLambdaHandler:
                 
                 # Verify get_alb_rule_priority was called
                 listener_arn = create_event["ResourceProperties"]["ListenerArn"]
-                mock_get_priority.assert_called_once_with(listener_arn)
+                owner = f"{create_event['StackId']}/{create_event['LogicalResourceId']}"
+                mock_get_priority.assert_called_once_with(listener_arn, owner, priority_range=index.ALB_RULE_PRIORITY_RANGE)
                 
                 # Verify send was called with correct data
                 mock_send.assert_called_once()
@@ -82,16 +88,16 @@ class TestInternalLambdaHandler:
 
     def test_create_with_multiple_priorities(self, create_event_with_count, mock_context, mock_elbv2_client, mock_http_client):
         """Test Create operation with multiple priorities."""
-        # Mock get_alb_rule_priority to return different values on each call
-        priorities = ["12345", "23456"]
-        with patch("src.index.get_alb_rule_priority", side_effect=priorities) as mock_get_priority:
+        # Mock get_alb_rule_priorities to return the whole batch from one call
+        priorities = ["23456", "12345"]
+        with patch("src.index.get_alb_rule_priorities", return_value=priorities) as mock_get_priorities:
             with patch("src.index.send") as mock_send:
                 index._lambda_handler(create_event_with_count, mock_context)
                 
-                # Verify get_alb_rule_priority was called twice
+                # Verify get_alb_rule_priorities was called once for the whole count
                 listener_arn = create_event_with_count["ResourceProperties"]["ListenerArn"]
-                assert mock_get_priority.call_count == 2
-                mock_get_priority.assert_has_calls([call(listener_arn), call(listener_arn)])
+                owner = f"{create_event_with_count['StackId']}/{create_event_with_count['LogicalResourceId']}"
+                mock_get_priorities.assert_called_once_with(listener_arn, 2, owner, contiguous=False, priority_range=index.ALB_RULE_PRIORITY_RANGE)
                 
                 # Verify send was called with correct data
                 mock_send.assert_called_once()
@@ -104,6 +110,69 @@ class TestInternalLambdaHandler:
                     "ListenerArn": listener_arn
                 }
 
+    def test_create_contiguous(self, create_event_with_count, mock_context):
+        """Test that the Contiguous property requests a consecutive block."""
+        create_event_with_count["ResourceProperties"]["Contiguous"] = "true"
+        with patch("src.index.get_alb_rule_priorities", return_value=["12345", "12346"]) as mock_get_priorities:
+            with patch("src.index.send") as mock_send:
+                index._lambda_handler(create_event_with_count, mock_context)
+
+                assert mock_get_priorities.call_args.kwargs["contiguous"] is True
+                assert mock_send.call_args[0][3]["Priorities"] == "12345,12346"
+
+    def test_create_with_priority_range(self, create_event_with_count, mock_context):
+        """Test that the PriorityRange property narrows the allocation range."""
+        create_event_with_count["ResourceProperties"]["PriorityRange"] = "20000-20999"
+        with patch("src.index.get_alb_rule_priorities", return_value=["20001", "20002"]) as mock_get_priorities:
+            with patch("src.index.send"):
+                index._lambda_handler(create_event_with_count, mock_context)
+
+                assert mock_get_priorities.call_args.kwargs["priority_range"] == (20000, 20999)
+
+    def test_create_with_shards(self, create_event_with_count, mock_context):
+        """Test that ShardCount allocates from the stack's shard of the range."""
+        create_event_with_count["ResourceProperties"]["PriorityRange"] = "20000-20999"
+        create_event_with_count["ResourceProperties"]["ShardCount"] = "10"
+        expected = index.shard_priority_range((20000, 20999), 10, create_event_with_count["StackId"])
+        with patch("src.index.get_alb_rule_priorities", return_value=["20001", "20002"]) as mock_get_priorities:
+            with patch("src.index.send"):
+                index._lambda_handler(create_event_with_count, mock_context)
+
+                assert mock_get_priorities.call_args.kwargs["priority_range"] == expected
+
+    def test_create_with_listener_arns(self, create_event_with_count, mock_context):
+        """Test that ListenerArns returns one priority set per listener in one invocation."""
+        properties = create_event_with_count["ResourceProperties"]
+        del properties["ListenerArn"]
+        properties["ListenerArns"] = ["listener-http", "listener-https"]
+        allocations = {"listener-http": ["20002", "20001"], "listener-https": ["30001", "30002"]}
+        with patch("src.index.get_alb_rule_priorities_for_listeners", return_value=allocations) as mock_get_priorities:
+            with patch("src.index.send") as mock_send:
+                index._lambda_handler(create_event_with_count, mock_context)
+
+                assert mock_get_priorities.call_args[0][:2] == (["listener-http", "listener-https"], 2)
+                assert mock_send.call_args[0][2] == index.SUCCESS
+                assert mock_send.call_args[0][3] == {
+                    "Priorities0": "20001,20002",
+                    "Priorities1": "30001,30002",
+                    "ListenerArns": "listener-http,listener-https",
+                }
+
+    def test_create_with_listener_arns_single(self, create_event, mock_context):
+        """Test that ListenerArns without a count returns one priority per listener."""
+        properties = create_event["ResourceProperties"]
+        properties["ListenerArns"] = "listener-http, listener-https"
+        allocations = {"listener-http": ["20001"], "listener-https": ["30001"]}
+        with patch("src.index.get_alb_rule_priorities_for_listeners", return_value=allocations):
+            with patch("src.index.send") as mock_send:
+                index._lambda_handler(create_event, mock_context)
+
+                assert mock_send.call_args[0][3] == {
+                    "Priority0": "20001",
+                    "Priority1": "30001",
+                    "ListenerArns": "listener-http,listener-https",
+                }
+
     def test_update_operation(self, update_event, mock_context, mock_elbv2_client, mock_http_client):
         """Test Update operation."""
         with patch("src.index.get_alb_rule_priority", return_value="12345") as mock_get_priority:
@@ -112,7 +181,8 @@ class TestInternalLambdaHandler:
                 
                 # Verify get_alb_rule_priority was called
                 listener_arn = update_event["ResourceProperties"]["ListenerArn"]
-                mock_get_priority.assert_called_once_with(listener_arn)
+                owner = f"{update_event['StackId']}/{update_event['LogicalResourceId']}"
+                mock_get_priority.assert_called_once_with(listener_arn, owner, priority_range=index.ALB_RULE_PRIORITY_RANGE)
                 
                 # Verify send was called with correct data
                 mock_send.assert_called_once()
@@ -166,6 +236,218 @@ class TestInternalLambdaHandler:
             assert kwargs.get('reason') == "No response data"
 
 
+class TestColdStart:
+    """Tests that requests which never allocate do not load boto3."""
+
+    def test_import_and_delete_skip_boto3(self, delete_event):
+        """Test that importing the module and handling a Delete leaves boto3 unimported."""
+        script = (
+            "import json, sys\n"
+            "from unittest.mock import MagicMock, patch\n"
+            "from src import index\n"
+            "with patch('http.client.HTTPSConnection') as conn:\n"
+            "    conn.return_value.getresponse.return_value.status = 200\n"
+            "    index.handler(json.loads(sys.argv[1]), MagicMock(log_stream_name='test-log-stream'))\n"
+            "print('boto3' in sys.modules, 'botocore' in sys.modules)\n"
+        )
+        output = subprocess.run([sys.executable, "-c", script, json.dumps(delete_event)], capture_output=True, text=True, check=True)
+
+        assert output.stdout.strip().splitlines()[-1] == "False False"
+
+
+class TestIdempotentUpdate:
+    """Tests for Updates that keep the priorities carried in the PhysicalResourceId."""
+
+    def test_physical_resource_id_round_trip(self):
+        """Test that priority sets survive encoding into the PhysicalResourceId."""
+        physical_id = index.encode_physical_resource_id("resource-id", [["10001", "10002"], ["20001", "20002"]])
+
+        assert physical_id == "resource-id:10001,10002;20001,20002"
+        assert index.decode_physical_resource_id(physical_id) == ("resource-id", [["10001", "10002"], ["20001", "20002"]])
+
+    def test_legacy_physical_resource_id(self):
+        """Test that an id without priorities decodes to no previous allocation."""
+        assert index.decode_physical_resource_id("test-physical-id") == ("test-physical-id", None)
+        assert index.decode_physical_resource_id(None) == (None, None)
+
+    def test_oversized_physical_resource_id(self):
+        """Test that allocations too large for the id fall back to the plain resource id."""
+        priority_sets = [[str(p) for p in range(10000, 10200)]]
+
+        assert index.encode_physical_resource_id("resource-id", priority_sets) == "resource-id"
+
+    def test_create_encodes_priorities(self, create_event_with_count, mock_context, mock_elbv2_client):
+        """Test that Create returns a PhysicalResourceId carrying the sorted priorities."""
+        with patch("src.index.send") as mock_send:
+            index._lambda_handler(create_event_with_count, mock_context)
+
+        data, physical_id = mock_send.call_args[0][3:5]
+        assert physical_id.endswith(":" + data["Priorities"])
+
+    def _update_event(self, update_event, old_count, new_count, previous):
+        update_event["PhysicalResourceId"] = f"resource-id:{previous}"
+        update_event["OldResourceProperties"]["PriorityCount"] = old_count
+        update_event["ResourceProperties"]["PriorityCount"] = new_count
+        return update_event
+
+    def test_unchanged_update_skips_elbv2(self, update_event, mock_context, mock_elbv2_client):
+        """Test that an Update without relevant changes returns the previous priorities without ELBv2 calls."""
+        event = self._update_event(update_event, "2", "2", "10001,10002")
+        event["ResourceProperties"]["ServiceToken"] = "arn:aws:lambda:us-east-1:123456789012:function:new-function"
+
+        with patch("src.index.send") as mock_send:
+            index._lambda_handler(event, mock_context)
+
+        mock_elbv2_client.describe_rules.assert_not_called()
+        assert mock_send.call_args[0][3]["Priorities"] == "10001,10002"
+        assert mock_send.call_args[0][4] == "resource-id:10001,10002"
+
+    def test_verify_change_skips_elbv2(self, update_event, mock_context, mock_elbv2_client):
+        """Test that turning on Verify or Rebalance keeps the previous priorities without ELBv2 calls."""
+        event = self._update_event(update_event, "2", "2", "12345,23456")
+        event["ResourceProperties"]["Verify"] = "true"
+        event["ResourceProperties"]["Rebalance"] = "true"
+
+        with patch("src.index.send") as mock_send:
+            index._lambda_handler(event, mock_context)
+
+        mock_elbv2_client.describe_rules.assert_not_called()
+        assert mock_send.call_args[0][4] == "resource-id:12345,23456"
+
+    def test_grow_keeps_previous_priorities(self, update_event, mock_context, mock_elbv2_client):
+        """Test that a larger PriorityCount keeps the previous priorities and adds new ones."""
+        event = self._update_event(update_event, "2", "3", "10001,10002")
+
+        with patch("random.randint", side_effect=[10001, 10001]), patch("src.index.send") as mock_send:
+            index._lambda_handler(event, mock_context)
+
+        mock_elbv2_client.describe_rules.assert_called_once()
+        assert mock_send.call_args[0][3]["Priorities"] == "10001,10002,10003"
+        assert mock_send.call_args[0][4] == "resource-id:10001,10002,10003"
+
+    def test_shrink_keeps_lowest_priorities(self, update_event, mock_context, mock_elbv2_client):
+        """Test that a smaller PriorityCount drops priorities without ELBv2 calls."""
+        event = self._update_event(update_event, "3", "2", "10001,10002,10003")
+
+        with patch("src.index.send") as mock_send:
+            index._lambda_handler(event, mock_context)
+
+        mock_elbv2_client.describe_rules.assert_not_called()
+        assert mock_send.call_args[0][3]["Priorities"] == "10001,10002"
+
+    def test_listener_change_reallocates(self, update_event, mock_context):
+        """Test that changing the listener allocates new priorities."""
+        event = self._update_event(update_event, "2", "2", "10001,10002")
+        event["ResourceProperties"]["ListenerArn"] = "other-listener-arn"
+
+        with patch("src.index.get_alb_rule_priorities", return_value=["30001", "30002"]) as mock_get_priorities:
+            with patch("src.index.send") as mock_send:
+                index._lambda_handler(event, mock_context)
+
+        assert mock_get_priorities.call_args[0][0] == "other-listener-arn"
+        assert mock_send.call_args[0][4] == "resource-id:30001,30002"
+
+    def test_contiguous_resize_reallocates(self, update_event, mock_context):
+        """Test that resizing a contiguous block allocates a whole new block."""
+        event = self._update_event(update_event, "2", "3", "10001,10002")
+        event["OldResourceProperties"]["Contiguous"] = "true"
+        event["ResourceProperties"]["Contiguous"] = "true"
+
+        with patch("src.index.get_alb_rule_priorities", return_value=["30001", "30002", "30003"]) as mock_get_priorities:
+            with patch("src.index.send"):
+                index._lambda_handler(event, mock_context)
+
+        assert mock_get_priorities.call_args.kwargs["contiguous"] is True
+        assert mock_get_priorities.call_args[0][1] == 3
+
+
+class TestReservationTracking:
+    """Tests for the bounded in-container reservation tracking and release."""
+
+    def test_reservations_expire(self):
+        """Test that reservations are dropped once their TTL has passed."""
+        now = [0]
+        with patch("time.monotonic", side_effect=lambda: now[0]):
+            index.reserve_priorities("listener-a", [10000])
+            now[0] = index.LOCAL_RESERVATION_TTL / 2
+            index.reserve_priorities("listener-b", [10001])
+            assert index.get_reserved_priorities("listener-a") == [10000]
+
+            now[0] = index.LOCAL_RESERVATION_TTL + 1
+            assert index.get_reserved_priorities("listener-a") == []
+            assert index.get_reserved_priorities("listener-b") == [10001]
+        assert list(index._RESERVATIONS) == ["listener-b"]
+
+    def test_reservations_bounded(self):
+        """Test that each listener keeps at most LOCAL_RESERVATION_MAX reservations."""
+        with patch.object(index, "LOCAL_RESERVATION_MAX", 3):
+            index.reserve_priorities("listener-a", [10000, 10001, 10002, 10003, 10004])
+
+        assert index.get_reserved_priorities("listener-a") == [10002, 10003, 10004]
+
+    def test_reservations_confirmed_by_snapshot(self, mock_elbv2_client):
+        """Test that a reservation is dropped once describe_rules shows a rule for it."""
+        index.reserve_priorities("test-listener-arn", [10, 20000])
+
+        index.get_rule_snapshot("test-listener-arn")
+
+        assert index.get_reserved_priorities("test-listener-arn") == [20000]
+
+    def test_delete_releases_priorities(self, delete_event, mock_context, tmp_path):
+        """Test that Delete releases the priorities carried in the PhysicalResourceId."""
+        backend = index.SQLiteReservationBackend(str(tmp_path / "reservations.db"))
+        index._RESERVATION_BACKEND = backend
+        listener_arn = delete_event["ResourceProperties"]["ListenerArn"]
+        owner = f"{delete_event['StackId']}/{delete_event['LogicalResourceId']}"
+        backend.claim(listener_arn, [10001, 10002], owner)
+        index.reserve_priorities(listener_arn, [10001, 10002])
+        delete_event["PhysicalResourceId"] = "resource-id:10001,10002"
+
+        with patch("src.index.send") as mock_send:
+            index._lambda_handler(delete_event, mock_context)
+
+        assert mock_send.call_args[0][2] == index.SUCCESS
+        assert index.get_reserved_priorities(listener_arn) == []
+        assert backend.claim(listener_arn, [10001, 10002], "other-stack") == [10001, 10002]
+
+    def test_cleanup_delete_keeps_updated_priorities(self, update_event, delete_event, mock_context, mock_elbv2_client, tmp_path):
+        """Test that the Delete of the id an Update replaced keeps the priorities the updated resource still holds."""
+        backend = index.SQLiteReservationBackend(str(tmp_path / "reservations.db"))
+        index._RESERVATION_BACKEND = backend
+        listener_arn = update_event["ResourceProperties"]["ListenerArn"]
+        owner = f"{update_event['StackId']}/{update_event['LogicalResourceId']}"
+        backend.claim(listener_arn, [10001, 10002, 10003], owner)
+        update_event["PhysicalResourceId"] = "resource-id:10001,10002,10003"
+        update_event["OldResourceProperties"]["PriorityCount"] = "3"
+        update_event["ResourceProperties"]["PriorityCount"] = "2"
+
+        with patch("src.index.send") as mock_send:
+            index._lambda_handler(update_event, mock_context)
+        assert mock_send.call_args[0][4] == "resource-id:10001,10002"
+
+        delete_event["PhysicalResourceId"] = "resource-id:10001,10002,10003"
+        with patch("src.index.send") as mock_send:
+            index._lambda_handler(delete_event, mock_context)
+
+        assert mock_send.call_args[0][2] == index.SUCCESS
+        assert index.get_reserved_priorities(listener_arn, owner) == [10001, 10002]
+        assert backend.claim(listener_arn, [10001, 10002, 10003], "other-stack") == [10003]
+
+    def test_failed_create_releases_priorities(self, create_event_with_count, mock_context, mock_elbv2_client, tmp_path):
+        """Test that priorities allocated by a Create that then fails are released and freed in the snapshot."""
+        backend = index.SQLiteReservationBackend(str(tmp_path / "reservations.db"))
+        index._RESERVATION_BACKEND = backend
+        listener_arn = create_event_with_count["ResourceProperties"]["ListenerArn"]
+
+        with patch("src.index.build_response_data", side_effect=RuntimeError("boom")), patch("src.index.send"):
+            with pytest.raises(RuntimeError, match="boom"):
+                index.handler(create_event_with_count, mock_context)
+
+        assert index.get_reserved_priorities(listener_arn) == []
+        assert not any(index.get_rule_snapshot(listener_arn)[index.ALB_RULE_PRIORITY_RANGE[0]:])
+        assert len(backend.claim(listener_arn, list(range(10000, 50001)), "other-stack")) == 40001
+
+
 class TestGetAlbRulePriority:
     """Tests for the get_alb_rule_priority function."""
 
@@ -196,23 +478,963 @@ class TestGetAlbRulePriority:
             assert priority not in in_use_priorities
             assert priority == "10003"
 
-    def test_priority_not_in_allocating(self, mock_elbv2_client):
-        """Test that the generated priority is not in the ALLOCATING list."""
-        # Add a priority to the ALLOCATING list
-        index.ALLOCATING = ["20000"]
+    def test_priority_not_reserved(self, mock_elbv2_client):
+        """Test that the generated priority is not one this container has already reserved."""
+        index.reserve_priorities("test-listener-arn", [20000])
         
         with patch("random.randint") as mock_randint:
-            # First return a priority that's in ALLOCATING, then one that's not
+            # First return a priority that's reserved, then one that's not
             mock_randint.side_effect = [20000, 20001]
             
             priority = index.get_alb_rule_priority("test-listener-arn")
             
-            # Verify the priority is not in the ALLOCATING list
-            assert priority not in index.ALLOCATING
+            # Verify the priority skipped the reserved one and was reserved itself
             assert priority == "20001"
-            
-            # Clean up
-            index.ALLOCATING = []
+            assert index.get_reserved_priorities("test-listener-arn") == [20000, 20001]
+
+
+class TestGetAlbRulePriorities:
+    """Tests for the get_alb_rule_priorities function."""
+
+    def test_single_describe_call(self, mock_elbv2_client):
+        """Test that all priorities are allocated from one describe_rules snapshot."""
+        priorities = index.get_alb_rule_priorities("test-listener-arn", 20)
+
+        mock_elbv2_client.describe_rules.assert_called_once_with(ListenerArn="test-listener-arn", PageSize=index.DESCRIBE_RULES_PAGE_SIZE)
+        assert len(priorities) == 20
+        assert len(set(priorities)) == 20
+        for priority in priorities:
+            assert index.ALB_RULE_PRIORITY_RANGE[0] <= int(priority) <= index.ALB_RULE_PRIORITY_RANGE[1]
+
+    def test_priorities_not_in_use(self, mock_elbv2_client):
+        """Test that batch allocation skips in-use priorities and repeats within the batch."""
+        mock_elbv2_client.describe_rules.return_value = {
+            "Rules": [{"Priority": "10000"}, {"Priority": "default"}]
+        }
+
+        with patch("random.randint") as mock_randint:
+            mock_randint.side_effect = [10000, 10001, 10001, 10002]
+
+            priorities = index.get_alb_rule_priorities("test-listener-arn", 2)
+
+            assert priorities == ["10001", "10002"]
+
+
+class TestListenerOccupancy:
+    """Tests for paginated describe_rules ingestion."""
+
+    def test_follows_next_marker(self):
+        """Test that every page is read and its priorities are marked as occupied."""
+        elbv2_client = MagicMock()
+        elbv2_client.describe_rules.side_effect = [
+            {"Rules": [{"Priority": "default"}, {"Priority": "10000"}], "NextMarker": "page-2"},
+            {"Rules": [{"Priority": "20000"}], "NextMarker": "page-3"},
+            {"Rules": [{"Priority": "50000"}]},
+        ]
+
+        occupancy = index.get_listener_occupancy(elbv2_client, "test-listener-arn", page_size=2)
+
+        assert elbv2_client.describe_rules.call_args_list == [
+            call(ListenerArn="test-listener-arn", PageSize=2),
+            call(ListenerArn="test-listener-arn", PageSize=2, Marker="page-2"),
+            call(ListenerArn="test-listener-arn", PageSize=2, Marker="page-3"),
+        ]
+        assert len(occupancy) == index.ALB_MAX_PRIORITY + 1
+        assert [p for p, used in enumerate(occupancy) if used] == [10000, 20000, 50000]
+
+    def test_priority_on_later_page_not_allocated(self, mock_elbv2_client):
+        """Test that priorities only visible on a later page are not handed out."""
+        mock_elbv2_client.describe_rules.side_effect = [
+            {"Rules": [{"Priority": "default"}], "NextMarker": "page-2"},
+            {"Rules": [{"Priority": "10000"}]},
+        ]
+
+        with patch("random.randint", side_effect=[10000, 10001]):
+            priority = index.get_alb_rule_priority("test-listener-arn")
+
+        assert priority == "10001"
+
+
+class TestPriorityRanges:
+    """Tests for per-resource priority ranges and range sharding."""
+
+    def test_parse_priority_range(self):
+        """Test that a valid PriorityRange is parsed into a tuple."""
+        assert index.parse_priority_range("20000-29999") == (20000, 29999)
+
+    @pytest.mark.parametrize("value", ["20000", "a-b", "0-100", "300-200", "49000-50001"])
+    def test_parse_priority_range_invalid(self, value):
+        """Test that malformed or out-of-bounds ranges are rejected."""
+        with pytest.raises(ValueError, match="PriorityRange"):
+            index.parse_priority_range(value)
+
+    def test_shards_partition_range(self):
+        """Test that the shards of a range are disjoint and cover it."""
+        shards = set()
+        for key in range(1000):
+            shards.add(index.shard_priority_range((10000, 50000), 7, f"stack-{key}"))
+
+        shards = sorted(shards)
+        assert len(shards) == 7
+        assert shards[0][0] == 10000
+        assert shards[-1][1] == 50000
+        for (_, previous_end), (start, _) in zip(shards, shards[1:]):
+            assert start == previous_end + 1
+
+    def test_shard_is_deterministic(self):
+        """Test that a key always maps to the same shard."""
+        first = index.shard_priority_range((10000, 50000), 16, "tenant-a")
+        assert index.shard_priority_range((10000, 50000), 16, "tenant-a") == first
+
+    def test_invalid_shard_count(self):
+        """Test that a shard count larger than the range is rejected."""
+        with pytest.raises(ValueError, match="ShardCount"):
+            index.shard_priority_range((100, 104), 6, "tenant-a")
+
+    def test_allocation_stays_in_range(self, mock_elbv2_client):
+        """Test that allocation only returns priorities inside the requested range."""
+        mock_elbv2_client.describe_rules.return_value = {"Rules": [{"Priority": "20001"}]}
+
+        priorities = index.get_alb_rule_priorities("test-listener-arn", 4, priority_range=(20000, 20004))
+
+        assert sorted(priorities) == ["20000", "20002", "20003", "20004"]
+
+    def test_full_range_reports_occupancy(self, mock_elbv2_client):
+        """Test that a range without enough free priorities fails with its free count."""
+        mock_elbv2_client.describe_rules.return_value = {"Rules": [{"Priority": "20001"}]}
+
+        with pytest.raises(index.PriorityRangeExhaustedError, match="only 1 are free in range 20000-20001"):
+            index.get_alb_rule_priorities("test-listener-arn", 2, priority_range=(20000, 20001))
+
+
+class TestRuleSnapshotCache:
+    """Tests for the module-level client and per-listener snapshot cache."""
+
+    def test_client_reused(self, mock_elbv2_client):
+        """Test that one boto3 client is created per container."""
+        with patch("boto3.client", return_value=mock_elbv2_client) as mock_boto3:
+            assert index.get_elbv2_client() is index.get_elbv2_client()
+            mock_boto3.assert_called_once()
+            assert mock_boto3.call_args.args == ("elbv2",)
+
+    def test_snapshot_reused_and_updated(self, mock_elbv2_client):
+        """Test that a warm snapshot skips describe_rules and already holds earlier allocations."""
+        first = index.get_alb_rule_priorities("test-listener-arn", 3)
+        index._RESERVATIONS.clear()
+        second = index.get_alb_rule_priorities("test-listener-arn", 3)
+
+        mock_elbv2_client.describe_rules.assert_called_once()
+        assert not set(first) & set(second)
+        assert index.CACHE_STATS == {"hits": 1, "misses": 1, "coalesced": 0}
+
+    def test_snapshot_expires(self, mock_elbv2_client):
+        """Test that a snapshot older than the TTL is read again."""
+        now = [0]
+        with patch("time.monotonic", side_effect=lambda: now[0]):
+            index.get_rule_snapshot("test-listener-arn")
+            now[0] = index.RULE_SNAPSHOT_TTL + 1
+            index.get_rule_snapshot("test-listener-arn")
+
+        assert mock_elbv2_client.describe_rules.call_count == 2
+        assert index.CACHE_STATS == {"hits": 0, "misses": 2, "coalesced": 0}
+
+    def test_least_recently_used_evicted(self, mock_elbv2_client):
+        """Test that the cache evicts the least recently used listener when full."""
+        with patch.object(index, "RULE_SNAPSHOT_CACHE_SIZE", 2):
+            index.get_rule_snapshot("listener-a")
+            index.get_rule_snapshot("listener-b")
+            index.get_rule_snapshot("listener-a")
+            index.get_rule_snapshot("listener-c")
+
+        assert list(index._RULE_SNAPSHOTS) == ["listener-a", "listener-c"]
+
+
+class TestReservationBackends:
+    """Tests for the durable reservation ledger backends."""
+
+    def test_sqlite_claim_is_conditional(self, tmp_path):
+        """Test that a priority claimed by one owner cannot be claimed by another."""
+        backend = index.SQLiteReservationBackend(str(tmp_path / "reservations.db"))
+
+        assert backend.claim("listener-a", [10000, 10001], "stack-1") == [10000, 10001]
+        assert backend.claim("listener-a", [10001, 10002], "stack-2") == [10002]
+        assert backend.claim("listener-b", [10001], "stack-2") == [10001]
+
+    def test_sqlite_claim_is_idempotent_for_owner(self, tmp_path):
+        """Test that the same owner can claim its own priorities again."""
+        backend = index.SQLiteReservationBackend(str(tmp_path / "reservations.db"))
+
+        backend.claim("listener-a", [10000], "stack-1")
+        assert backend.claim("listener-a", [10000], "stack-1") == [10000]
+
+    def test_sqlite_expired_claim_can_be_taken(self, tmp_path):
+        """Test that a claim past its TTL can be taken by another owner."""
+        backend = index.SQLiteReservationBackend(str(tmp_path / "reservations.db"))
+
+        with patch.object(index, "RESERVATION_TTL", -1):
+            backend.claim("listener-a", [10000], "stack-1")
+        assert backend.claim("listener-a", [10000], "stack-2") == [10000]
+
+    def test_sqlite_release_only_own_claims(self, tmp_path):
+        """Test that releasing only frees priorities held by the owner."""
+        backend = index.SQLiteReservationBackend(str(tmp_path / "reservations.db"))
+        backend.claim("listener-a", [10000, 10001], "stack-1")
+
+        backend.release("listener-a", [10000, 10001], "stack-2")
+        assert backend.claim("listener-a", [10000], "stack-2") == []
+
+        backend.release("listener-a", [10000, 10001], "stack-1")
+        assert backend.claim("listener-a", [10000, 10001], "stack-2") == [10000, 10001]
+
+    def test_backend_requires_claim_and_release(self):
+        """Test that a backend missing claim or release cannot be instantiated."""
+        class ClaimOnly(index.ReservationBackend):
+            def claim(self, listener_arn, priorities, owner, physical_resource_id=None):
+                return priorities
+
+        with pytest.raises(TypeError):
+            ClaimOnly()
+
+    def test_dynamodb_claim_retries_without_conflicts(self):
+        """Test that a cancelled transaction is retried with only the unconflicted priorities."""
+        client = MagicMock()
+        client.transact_write_items.side_effect = [
+            ClientError({
+                "Error": {"Code": "TransactionCanceledException", "Message": "cancelled"},
+                "CancellationReasons": [{"Code": "None"}, {"Code": "ConditionalCheckFailed"}, {"Code": "None"}],
+            }, "TransactWriteItems"),
+            {},
+        ]
+        backend = index.DynamoDBReservationBackend("reservations", client=client)
+
+        assert backend.claim("listener-a", [10000, 10001, 10002], "stack-1") == [10000, 10002]
+
+        assert client.transact_write_items.call_count == 2
+        retried = client.transact_write_items.call_args.kwargs["TransactItems"]
+        assert [item["Put"]["Item"]["Priority"]["N"] for item in retried] == ["10000", "10002"]
+        assert retried[0]["Put"]["ConditionExpression"] == "attribute_not_exists(#priority) OR #owner = :owner OR ExpiresAt < :now"
+
+    def test_dynamodb_claim_retries_transaction_conflicts(self):
+        """Test that priorities cancelled by a transaction conflict or throttling are retried, not dropped."""
+        client = MagicMock()
+        client.transact_write_items.side_effect = [
+            ClientError({
+                "Error": {"Code": "TransactionCanceledException", "Message": "cancelled"},
+                "CancellationReasons": [{"Code": "TransactionConflict"}, {"Code": "ConditionalCheckFailed"}, {"Code": "ThrottlingError"}],
+            }, "TransactWriteItems"),
+            {},
+        ]
+        backend = index.DynamoDBReservationBackend("reservations", client=client)
+
+        with patch("time.sleep") as mock_sleep:
+            assert backend.claim("listener-a", [10000, 10001, 10002], "stack-1") == [10000, 10002]
+
+        mock_sleep.assert_called_once()
+        retried = client.transact_write_items.call_args.kwargs["TransactItems"]
+        assert [item["Put"]["Item"]["Priority"]["N"] for item in retried] == ["10000", "10002"]
+
+    def test_dynamodb_claim_gives_up_on_persistent_throttling(self):
+        """Test that priorities still throttled after MAX_ATTEMPTS are reported as not claimed."""
+        throttled = ClientError({
+            "Error": {"Code": "TransactionCanceledException", "Message": "cancelled"},
+            "CancellationReasons": [{"Code": "None"}, {"Code": "ThrottlingError"}],
+        }, "TransactWriteItems")
+        client = MagicMock()
+        client.transact_write_items.side_effect = [throttled] * index.DynamoDBReservationBackend.MAX_ATTEMPTS + [{}]
+        backend = index.DynamoDBReservationBackend("reservations", client=client)
+
+        with patch("time.sleep"):
+            assert backend.claim("listener-a", [10000, 10001], "stack-1") == [10000]
+
+        assert client.transact_write_items.call_count == index.DynamoDBReservationBackend.MAX_ATTEMPTS + 1
+
+    def test_dynamodb_claim_gives_up_after_conflicts_then_throttling(self):
+        """Test that conflict-only rounds do not stop persistent throttling from being given up on."""
+        def cancelled(*codes):
+            return ClientError({
+                "Error": {"Code": "TransactionCanceledException", "Message": "cancelled"},
+                "CancellationReasons": [{"Code": code} for code in codes],
+            }, "TransactWriteItems")
+
+        max_attempts = index.DynamoDBReservationBackend.MAX_ATTEMPTS
+        conflicts = [cancelled("ConditionalCheckFailed", *["None"] * (max_attempts + 1 - n)) for n in range(max_attempts)]
+        client = MagicMock()
+        client.transact_write_items.side_effect = conflicts + [cancelled("ThrottlingError")] * max_attempts + [AssertionError("not given up")]
+        backend = index.DynamoDBReservationBackend("reservations", client=client)
+
+        with patch("time.sleep"):
+            assert backend.claim("listener-a", list(range(10000, 10000 + max_attempts + 1)), "stack-1") == []
+
+        assert client.transact_write_items.call_count == 2 * max_attempts
+
+    def test_dynamodb_claims_batched(self):
+        """Test that claims are written in transactions of at most BATCH_SIZE items."""
+        client = MagicMock()
+        backend = index.DynamoDBReservationBackend("reservations", client=client)
+
+        claimed = backend.claim("listener-a", list(range(10000, 10250)), "stack-1")
+
+        assert len(claimed) == 250
+        assert [len(c.kwargs["TransactItems"]) for c in client.transact_write_items.call_args_list] == [100, 100, 50]
+
+    def test_allocation_skips_priorities_reserved_elsewhere(self, mock_elbv2_client, tmp_path):
+        """Test that priorities claimed by another container are replaced from the snapshot."""
+        backend = index.SQLiteReservationBackend(str(tmp_path / "reservations.db"))
+        backend.claim("test-listener-arn", [10000], "other-stack")
+        index._RESERVATION_BACKEND = backend
+
+        with patch("random.randint", side_effect=[10000, 10000]):
+            priorities = index.get_alb_rule_priorities("test-listener-arn", 1, "this-stack")
+
+        assert priorities == ["10001"]
+        assert backend.claim("test-listener-arn", [10001], "other-stack") == []
+
+
+    def test_contiguous_block_reallocated_on_conflict(self, mock_elbv2_client, tmp_path):
+        """Test that a partly reserved block is given back and a whole new block is taken."""
+        backend = index.SQLiteReservationBackend(str(tmp_path / "reservations.db"))
+        mock_elbv2_client.describe_rules.return_value = {"Rules": [{"Priority": "10003"}]}
+        backend.claim("test-listener-arn", [10001], "other-stack")
+        index._RESERVATION_BACKEND = backend
+
+        # Best fit for a block of 3 is 10000-10002, which collides on 10001
+        priorities = index.get_alb_rule_priorities("test-listener-arn", 3, "this-stack", contiguous=True)
+
+        assert priorities == ["10004", "10005", "10006"]
+        assert backend.claim("test-listener-arn", [10000, 10002], "other-stack") == [10000, 10002]
+
+
+class TestMultipleListeners:
+    """Tests for allocation across several listeners."""
+
+    def test_one_describe_per_listener(self, mock_elbv2_client):
+        """Test that each listener is read once with the shared client."""
+        with patch("boto3.client", return_value=mock_elbv2_client) as mock_boto3:
+            allocations = index.get_alb_rule_priorities_for_listeners(["listener-a", "listener-b", "listener-a"], 3)
+
+        mock_boto3.assert_called_once()
+        assert sorted(c.kwargs["ListenerArn"] for c in mock_elbv2_client.describe_rules.call_args_list) == ["listener-a", "listener-b"]
+        assert list(allocations) == ["listener-a", "listener-b"]
+        assert all(len(set(priorities)) == 3 for priorities in allocations.values())
+
+    def test_describe_calls_run_concurrently(self, mock_elbv2_client):
+        """Test that the describe_rules calls overlap instead of running one after another."""
+        barrier = threading.Barrier(3, timeout=5)
+
+        def describe_rules(**kwargs):
+            barrier.wait()
+            return {"Rules": []}
+
+        mock_elbv2_client.describe_rules.side_effect = describe_rules
+
+        allocations = index.get_alb_rule_priorities_for_listeners(["listener-a", "listener-b", "listener-c"], 1)
+
+        assert len(allocations) == 3
+
+
+class TestElbv2RateLimiting:
+    """Tests for the shared ELBv2 rate limiter and request coalescing."""
+
+    @staticmethod
+    def throttling_error():
+        return ClientError({"Error": {"Code": "Throttling", "Message": "Rate exceeded"}}, "DescribeRules")
+
+    def test_token_bucket_backs_off_and_recovers(self):
+        """Test that throttling halves the rate and successes win it back gradually."""
+        bucket = index.TokenBucket(10, 10)
+        bucket.on_throttle()
+        bucket.on_throttle()
+        assert bucket.rate == 2.5
+
+        for _ in range(20):
+            bucket.on_success()
+        assert bucket.rate == 10
+
+    def test_token_bucket_waits_when_empty(self):
+        """Test that acquire sleeps for the refill time once the burst is spent."""
+        now = [0]
+        with patch("time.monotonic", side_effect=lambda: now[0]):
+            bucket = index.TokenBucket(4, 1)
+            bucket.acquire()
+            with patch("time.sleep", side_effect=lambda s: now.__setitem__(0, now[0] + s)) as mock_sleep:
+                bucket.acquire()
+
+        mock_sleep.assert_called_once_with(0.25)
+
+    def test_throttling_retried(self):
+        """Test that a throttled call is retried and the limiter slows down."""
+        method = MagicMock(side_effect=[self.throttling_error(), {"Rules": []}])
+
+        with patch("time.sleep"):
+            assert index.call_elbv2(method, ListenerArn="test-listener-arn") == {"Rules": []}
+
+        assert method.call_count == 2
+        assert index._ELBV2_LIMITER.rate < index._ELBV2_LIMITER.max_rate
+        assert index._METRICS["ThrottledCalls"] == ("Count", [1])
+
+    def test_other_errors_not_retried(self):
+        """Test that non-throttling errors are raised on the first attempt."""
+        error = ClientError({"Error": {"Code": "ListenerNotFound", "Message": "Not found"}}, "DescribeRules")
+        method = MagicMock(side_effect=error)
+
+        with pytest.raises(ClientError):
+            index.call_elbv2(method, ListenerArn="test-listener-arn")
+
+        method.assert_called_once()
+
+    def test_throttling_attempts_bounded(self):
+        """Test that the throttling error is raised once the attempts run out."""
+        method = MagicMock(side_effect=self.throttling_error())
+
+        with patch("time.sleep"), pytest.raises(ClientError):
+            index.call_elbv2(method)
+
+        assert method.call_count == index.ELBV2_MAX_ATTEMPTS
+
+    def test_client_mode_is_only_retry_layer(self, monkeypatch):
+        """Test that in client mode botocore makes one attempt per call, so throttled calls are not retried twice."""
+        from benchmarks.servers import AWS_ENVIRONMENT, FakeElbv2Server
+
+        for name, value in AWS_ENVIRONMENT.items():
+            monkeypatch.setenv(name, value)
+        with FakeElbv2Server({"test-listener-arn": []}, throttle_rate=1.0) as server, patch("time.sleep"):
+            monkeypatch.setenv("AWS_ENDPOINT_URL_ELASTIC_LOAD_BALANCING_V2", server.url)
+            with pytest.raises(ClientError, match="Throttling"):
+                index.get_alb_rule_priority("test-listener-arn")
+
+        assert server.calls["DescribeRules"] == index.ELBV2_MAX_ATTEMPTS
+
+    def test_adaptive_retry_mode(self, mock_elbv2_client):
+        """Test that adaptive mode hands retries to botocore and skips the local limiter."""
+        method = MagicMock(side_effect=self.throttling_error())
+
+        with patch.object(index, "ELBV2_RETRY_MODE", "adaptive"):
+            with patch("boto3.client", return_value=mock_elbv2_client) as mock_boto3:
+                index.get_elbv2_client()
+            with pytest.raises(ClientError):
+                index.call_elbv2(method)
+
+        config = mock_boto3.call_args.kwargs["config"]
+        assert config.retries == {"mode": "adaptive", "max_attempts": index.ELBV2_MAX_ATTEMPTS}
+        method.assert_called_once()
+
+    def test_concurrent_snapshot_reads_coalesced(self, mock_elbv2_client):
+        """Test that concurrent cold reads of one listener share a single describe_rules call."""
+        started = threading.Event()
+        release = threading.Event()
+
+        def describe_rules(**kwargs):
+            started.set()
+            release.wait(5)
+            return {"Rules": [{"Priority": "10000"}]}
+
+        mock_elbv2_client.describe_rules.side_effect = describe_rules
+        results = []
+
+        def read():
+            results.append(index.get_rule_snapshot("test-listener-arn"))
+
+        leader = threading.Thread(target=read)
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=read) for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        for _ in range(5000):
+            if index.CACHE_STATS["coalesced"] == 3:
+                break
+            threading.Event().wait(0.001)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        mock_elbv2_client.describe_rules.assert_called_once()
+        assert len(results) == 4 and all(result is results[0] for result in results)
+        assert results[0][10000] == 1
+
+    def test_coalesced_read_failure_propagates(self, mock_elbv2_client):
+        """Test that a failed read is not cached and the next read tries again."""
+        mock_elbv2_client.describe_rules.side_effect = [RuntimeError("boom"), {"Rules": []}]
+
+        with pytest.raises(RuntimeError):
+            index.get_rule_snapshot("test-listener-arn")
+
+        assert not index._IN_FLIGHT
+        index.get_rule_snapshot("test-listener-arn")
+        assert mock_elbv2_client.describe_rules.call_count == 2
+
+
+class TestPriorityAllocator:
+    """Tests for the free-interval PriorityAllocator."""
+
+    def test_free_intervals_from_occupancy(self):
+        """Test that occupied priorities split the range into free intervals."""
+        occupancy = bytearray(index.ALB_MAX_PRIORITY + 1)
+        for priority in (100, 101, 105, 110):
+            occupancy[priority] = 1
+
+        allocator = index.PriorityAllocator(occupancy, (100, 110))
+
+        assert allocator.free == 7
+        assert allocator.used == 4
+        assert allocator.utilisation == pytest.approx(4 / 11)
+        assert sorted(allocator.allocate_many(7)) == [102, 103, 104, 106, 107, 108, 109]
+
+    def test_allocate_wraps_to_first_interval(self):
+        """Test that a target past the last free interval wraps around to the first one."""
+        occupancy = bytearray(index.ALB_MAX_PRIORITY + 1)
+        occupancy[110] = 1
+
+        allocator = index.PriorityAllocator(occupancy, (100, 110))
+
+        with patch("random.randint", return_value=110):
+            assert allocator.allocate() == 100
+
+    def test_allocate_block_best_fit(self):
+        """Test that a block comes from the smallest free interval that can hold it."""
+        occupancy = bytearray(index.ALB_MAX_PRIORITY + 1)
+        for priority in (105, 109):
+            occupancy[priority] = 1
+
+        # Free intervals: 100-104 (5), 106-108 (3), 110-120 (11)
+        allocator = index.PriorityAllocator(occupancy, (100, 120))
+
+        assert allocator.allocate_block(3) == [106, 107, 108]
+        assert allocator.allocate_block(4) == [100, 101, 102, 103]
+        assert allocator.allocate_block(2) == [110, 111]
+        assert allocator.free == 19 - 9
+
+    def test_allocate_block_fails_without_run(self):
+        """Test that a block longer than every free interval fails even when enough are free."""
+        occupancy = bytearray(index.ALB_MAX_PRIORITY + 1)
+        occupancy[103] = 1
+
+        allocator = index.PriorityAllocator(occupancy, (100, 106))
+
+        with pytest.raises(index.PriorityRangeExhaustedError, match="largest is 3"):
+            allocator.allocate_block(4)
+        assert allocator.free == 6
+
+    def test_range_exhausted(self):
+        """Test that a full range fails immediately instead of sampling forever."""
+        occupancy = bytearray(index.ALB_MAX_PRIORITY + 1)
+        occupancy[100:111] = b"\x01" * 11
+
+        allocator = index.PriorityAllocator(occupancy, (100, 110))
+
+        assert allocator.free == 0
+        with pytest.raises(index.PriorityRangeExhaustedError):
+            allocator.allocate()
+
+    def test_allocate_many_fails_fast(self):
+        """Test that a batch larger than the free count fails before taking anything."""
+        occupancy = bytearray(index.ALB_MAX_PRIORITY + 1)
+
+        allocator = index.PriorityAllocator(occupancy, (100, 102))
+
+        with pytest.raises(index.PriorityRangeExhaustedError, match="only 3 are free"):
+            allocator.allocate_many(4)
+        assert allocator.free == 3
+
+    def test_allocate_blocks_largest_first(self):
+        """Test that a batch of blocks is placed largest first and returned in request order."""
+        occupancy = bytearray(index.ALB_MAX_PRIORITY + 1)
+        for priority in (105, 109):
+            occupancy[priority] = 1
+
+        # Free intervals: 100-104 (5), 106-108 (3), 110-120 (11)
+        allocator = index.PriorityAllocator(occupancy, (100, 120))
+
+        assert allocator.allocate_blocks([2, 5, 3]) == [[110, 111], [100, 101, 102, 103, 104], [106, 107, 108]]
+        assert allocator.free == 9
+        assert sorted(allocator.allocate_many(9)) == list(range(112, 121))
+
+
+class TestHashedAllocation:
+    """Tests for the deterministic hashed-probe allocation strategy."""
+
+    OWNER = "arn:aws:cloudformation:us-east-1:123456789012:stack/test-stack/test-stack-id/ListenerRuleAllocation"
+
+    def test_hash_priority_in_range(self):
+        """Test that hashed starting points are stable and stay in the range."""
+        targets = [index.hash_priority(self.OWNER, i, (20000, 20099)) for i in range(50)]
+
+        assert targets == [index.hash_priority(self.OWNER, i, (20000, 20099)) for i in range(50)]
+        assert all(20000 <= target <= 20099 for target in targets)
+        assert len(set(targets)) > 1
+
+    def test_probes_forward_to_next_free(self):
+        """Test that a taken starting point probes forward, wrapping to the start of the range."""
+        occupancy = bytearray(index.ALB_MAX_PRIORITY + 1)
+        occupancy[105:111] = b"\x01" * 6
+
+        allocator = index.PriorityAllocator(occupancy, (100, 110))
+
+        with patch("src.index.hash_priority", side_effect=[106, 101]):
+            assert allocator.allocate_hashed("key", [0, 1]) == [100, 101]
+
+    def test_block_at_target(self):
+        """Test that a hashed block takes the first run that fits at or after its starting point."""
+        occupancy = bytearray(index.ALB_MAX_PRIORITY + 1)
+        occupancy[104] = 1
+
+        allocator = index.PriorityAllocator(occupancy, (100, 110))
+
+        assert allocator.allocate_block(3, target=102) == [105, 106, 107]
+        assert allocator.allocate_block(3, target=109) == [100, 101, 102]
+        assert allocator.free == 4
+
+    def test_retry_gets_same_priorities(self, mock_elbv2_client):
+        """Test that a retry by the same owner in a warm container gets the same priorities back."""
+        first = index.get_alb_rule_priorities("test-listener-arn", 3, self.OWNER, strategy="hashed")
+        second = index.get_alb_rule_priorities("test-listener-arn", 3, self.OWNER, strategy="Hashed")
+        index._RULE_SNAPSHOTS.clear()
+        index._RESERVATIONS.clear()
+        cold = index.get_alb_rule_priorities("test-listener-arn", 3, self.OWNER, strategy="hashed")
+
+        assert first == second == cold
+        assert index.get_reserved_priorities("test-listener-arn", self.OWNER) == [int(p) for p in first]
+
+    def test_other_owner_avoids_priorities(self, mock_elbv2_client):
+        """Test that another owner's hashed allocation skips priorities already handed out."""
+        with patch("src.index.hash_priority", return_value=20000):
+            first = index.get_alb_rule_priority("test-listener-arn", "stack-a/Rule", strategy="hashed")
+            second = index.get_alb_rule_priority("test-listener-arn", "stack-b/Rule", strategy="hashed")
+
+        assert (first, second) == ("20000", "20001")
+
+    def test_grow_keeps_existing_priorities_out(self, mock_elbv2_client):
+        """Test that topping up an allocation never returns a priority the owner already has."""
+        first = index.get_alb_rule_priorities("test-listener-arn", 2, self.OWNER, strategy="hashed")
+        extra = index.get_alb_rule_priorities("test-listener-arn", 2, self.OWNER, strategy="hashed", exclude=first)
+
+        assert not set(first) & set(extra)
+
+    def test_invalid_strategy(self, mock_elbv2_client):
+        """Test that an unknown strategy is rejected."""
+        with pytest.raises(ValueError, match="AllocationStrategy"):
+            index.get_alb_rule_priority("test-listener-arn", strategy="sequential")
+
+    def test_handler_passes_strategy(self, create_event_with_count, mock_context):
+        """Test that the AllocationStrategy property reaches the allocator."""
+        create_event_with_count["ResourceProperties"]["AllocationStrategy"] = "Hashed"
+        with patch("src.index.get_alb_rule_priorities", return_value=["20001", "20002"]) as mock_get_priorities:
+            with patch("src.index.send"):
+                index._lambda_handler(create_event_with_count, mock_context)
+
+        assert mock_get_priorities.call_args.kwargs["strategy"] == "Hashed"
+
+
+class TestOrderedAllocation:
+    """Tests for Before/After allocation with gap numbering."""
+
+    RULE_ARN = "arn:aws:elasticloadbalancing:eu-west-1:123456789012:listener-rule/app/web/50dc6c495c0c9188/f2f7dc8efc522ab2"
+
+    def listener(self, mock_elbv2_client, priorities):
+        rules = [{"RuleArn": f"{self.RULE_ARN}/{p}", "Priority": str(p)} for p in priorities]
+
+        def describe_rules(**kwargs):
+            if "RuleArns" in kwargs:
+                return {"Rules": [rule for rule in rules if rule["RuleArn"] in kwargs["RuleArns"]]}
+            return {"Rules": [{"RuleArn": f"{self.RULE_ARN}/default", "Priority": "default"}, *rules]}
+
+        mock_elbv2_client.describe_rules.side_effect = describe_rules
+
+    def test_after_takes_middle_of_gap(self, mock_elbv2_client):
+        """Test that After picks the middle of the gap up to the next rule."""
+        assert index.get_alb_rule_priority("test-listener-arn", after="5") == "7"
+
+    def test_before_takes_middle_of_gap(self, mock_elbv2_client):
+        """Test that Before picks the middle of the gap down to the previous rule."""
+        assert index.get_alb_rule_priority("test-listener-arn", before=5) == "3"
+
+    def test_count_spread_over_gap(self, mock_elbv2_client):
+        """Test that several priorities are spaced evenly, leaving room between them."""
+        self.listener(mock_elbv2_client, [100, 200])
+
+        assert index.get_alb_rule_priorities("test-listener-arn", 3, after=100) == ["125", "150", "175"]
+
+    def test_rule_arn_anchor(self, mock_elbv2_client):
+        """Test that a rule ARN anchor is resolved to that rule's priority."""
+        self.listener(mock_elbv2_client, [100, 200])
+
+        assert index.get_alb_rule_priority("test-listener-arn", before=f"{self.RULE_ARN}/200") == "150"
+        mock_elbv2_client.describe_rules.assert_any_call(RuleArns=[f"{self.RULE_ARN}/200"])
+
+    def test_later_insert_lands_between(self, mock_elbv2_client):
+        """Test that a second insert after the same rule goes between the rule and the first insert."""
+        self.listener(mock_elbv2_client, [100, 200])
+
+        first = index.get_alb_rule_priority("test-listener-arn", after=100)
+        second = index.get_alb_rule_priority("test-listener-arn", after=100)
+
+        assert 100 < int(second) < int(first) < 200
+
+    def test_full_gap_fails_without_rebalance(self, mock_elbv2_client):
+        """Test that a full gap fails rather than moving other rules unasked."""
+        self.listener(mock_elbv2_client, [100, 101])
+
+        with pytest.raises(index.PriorityRangeExhaustedError, match="Only 0 free priorities between 100 and 101"):
+            index.get_alb_rule_priority("test-listener-arn", after=100)
+        mock_elbv2_client.set_rule_priorities.assert_not_called()
+
+    def test_rebalance_moves_fewest_rules(self, mock_elbv2_client):
+        """Test that a rebalance pushes the shorter run of neighbouring rules in one call."""
+        self.listener(mock_elbv2_client, [99, 100, 101, 102, 103])
+
+        priority = index.get_alb_rule_priority("test-listener-arn", after=100, rebalance=True)
+
+        assert priority == "100"
+        mock_elbv2_client.set_rule_priorities.assert_called_once_with(RulePriorities=[
+            {"RuleArn": f"{self.RULE_ARN}/99", "Priority": 98},
+            {"RuleArn": f"{self.RULE_ARN}/100", "Priority": 99},
+        ])
+        occupancy = index._RULE_SNAPSHOTS["test-listener-arn"][1]
+        assert [p for p in range(97, 105) if occupancy[p]] == [98, 99, 100, 101, 102, 103]
+
+    def test_rebalance_claims_destinations(self, mock_elbv2_client, tmp_path):
+        """Test that the priorities rules move to are held in the ledger while the rules move."""
+        self.listener(mock_elbv2_client, [99, 100, 101, 102, 103])
+        backend = index.SQLiteReservationBackend(str(tmp_path / "reservations.db"))
+        index._RESERVATION_BACKEND = backend
+        held = []
+        mock_elbv2_client.set_rule_priorities.side_effect = lambda **kwargs: held.append(backend.claim("test-listener-arn", [98], "other-stack"))
+
+        index.get_alb_rule_priority("test-listener-arn", "this-stack", after=100, rebalance=True)
+
+        assert held == [[]]
+        assert backend.claim("test-listener-arn", [98], "other-stack") == [98]
+
+    def test_rebalance_stops_on_claimed_destination(self, mock_elbv2_client, tmp_path):
+        """Test that no rule is moved onto a priority another allocation has claimed."""
+        self.listener(mock_elbv2_client, [99, 100, 101, 102, 103])
+        backend = index.SQLiteReservationBackend(str(tmp_path / "reservations.db"))
+        backend.claim("test-listener-arn", [98], "other-stack")
+        index._RESERVATION_BACKEND = backend
+
+        with pytest.raises(index.PriorityRangeExhaustedError, match="reserved by another allocation"):
+            index.get_alb_rule_priority("test-listener-arn", "this-stack", after=100, rebalance=True)
+        mock_elbv2_client.set_rule_priorities.assert_not_called()
+
+    def test_before_and_after_exclusive(self, mock_elbv2_client):
+        """Test that Before and After cannot be combined."""
+        with pytest.raises(ValueError):
+            index.get_alb_rule_priority("test-listener-arn", before=10, after=5)
+
+    def test_contiguous_rejected_with_anchor(self, mock_elbv2_client):
+        """Test that Contiguous with Before or After fails instead of silently spreading the priorities."""
+        with pytest.raises(ValueError, match="Contiguous cannot be combined"):
+            index.get_alb_rule_priorities("test-listener-arn", 3, contiguous=True, after=100)
+        mock_elbv2_client.describe_rules.assert_not_called()
+
+    def test_handler_passes_ordering(self, create_event, mock_context):
+        """Test that the Before and Rebalance properties reach the allocator."""
+        create_event["ResourceProperties"]["Before"] = "20000"
+        create_event["ResourceProperties"]["Rebalance"] = "true"
+        with patch("src.index.get_alb_rule_priority", return_value="19999") as mock_get_priority:
+            with patch("src.index.send"):
+                index._lambda_handler(create_event, mock_context)
+
+        assert mock_get_priority.call_args.kwargs == {"priority_range": index.ALB_RULE_PRIORITY_RANGE, "before": "20000", "rebalance": True}
+
+
+class TestVerification:
+    """Tests for re-checking allocations just before responding."""
+
+    def reads(self, mock_elbv2_client, *taken):
+        """Serve one describe_rules result per read, each listing the given priorities."""
+        mock_elbv2_client.describe_rules.side_effect = [{"Rules": [{"Priority": str(p)} for p in priorities]} for priorities in taken]
+
+    def test_unchanged_listener_keeps_priorities(self, mock_elbv2_client):
+        """Test that priorities nobody took are returned after one more read."""
+        self.reads(mock_elbv2_client, [], [])
+        priorities = index.get_alb_rule_priorities("test-listener-arn", 2, "owner")
+
+        verified = index.verify_priorities(["test-listener-arn"], [priorities], [[]], "owner", index.time.monotonic() + 5)
+
+        assert verified == [priorities]
+        assert mock_elbv2_client.describe_rules.call_count == 2
+
+    def test_only_conflicts_replaced(self, mock_elbv2_client):
+        """Test that a priority taken meanwhile is replaced and the replacement checked again."""
+        with patch("random.randint", side_effect=[20000, 20001, 20002]):
+            self.reads(mock_elbv2_client, [], [20001], [20001])
+            priorities = index.get_alb_rule_priorities("test-listener-arn", 2, "owner")
+
+            verified = index.verify_priorities(["test-listener-arn"], [priorities], [[]], "owner", index.time.monotonic() + 5)
+
+        assert verified == [["20000", "20002"]]
+        assert mock_elbv2_client.describe_rules.call_count == 3
+        assert index._METRICS["VerificationConflicts"] == ("Count", [1])
+        assert 20001 not in index.get_reserved_priorities("test-listener-arn")
+
+    def test_contiguous_block_moves_whole(self, mock_elbv2_client):
+        """Test that a block with one taken priority is replaced by a new block."""
+        self.reads(mock_elbv2_client, [], [10001], [10001])
+        priorities = index.get_alb_rule_priorities("test-listener-arn", 3, "owner", contiguous=True, priority_range=(10000, 10010))
+        assert priorities == ["10000", "10001", "10002"]
+
+        verified = index.verify_priorities(["test-listener-arn"], [priorities], [[]], "owner", index.time.monotonic() + 5,
+                                           contiguous=True, priority_range=(10000, 10010))
+
+        assert verified == [["10002", "10003", "10004"]]
+
+    def test_kept_priorities_not_checked(self, mock_elbv2_client):
+        """Test that priorities kept from an earlier allocation are not treated as conflicts with their own rules."""
+        verified = index.verify_priorities(["test-listener-arn"], [["10"]], [["10"]], "owner", index.time.monotonic() + 5)
+
+        assert verified == [["10"]]
+        mock_elbv2_client.describe_rules.assert_not_called()
+
+    def test_time_budget(self, mock_elbv2_client):
+        """Test that verification stops once its time budget is spent."""
+        verified = index.verify_priorities(["test-listener-arn"], [["20000"]], [[]], "owner", index.time.monotonic() - 1)
+
+        assert verified == [["20000"]]
+        mock_elbv2_client.describe_rules.assert_not_called()
+
+    def test_handler_verifies_when_asked(self, create_event_with_count, mock_context, mock_elbv2_client):
+        """Test that the Verify property runs verification within the configured budget."""
+        create_event_with_count["ResourceProperties"]["Verify"] = "true"
+        with patch("src.index.verify_priorities", side_effect=lambda listeners, sets, *args, **kwargs: sets) as mock_verify:
+            with patch("src.index.send"):
+                index._lambda_handler(create_event_with_count, mock_context)
+
+        listeners, priority_sets, kept_sets, owner, deadline = mock_verify.call_args.args
+        assert kept_sets == [[]]
+        assert deadline <= index.time.monotonic() + index.VERIFY_TIME_BUDGET
+
+
+class TestListenerAnalytics:
+    """Tests for the AnalyzeListeners invocation mode."""
+
+    def test_analyze_listener(self, mock_elbv2_client):
+        """Test the counts, extents and fragmentation of a listener's range."""
+        mock_elbv2_client.describe_rules.return_value = {"Rules": [{"Priority": "default"}, *({"Priority": str(p)} for p in (102, 103, 110))]}
+
+        report = index.analyze_listener("test-listener-arn", (100, 119), allocations_per_day=4, top=2)
+
+        assert report == {
+            "PriorityRange": "100-119",
+            "Used": 3,
+            "Free": 17,
+            "Utilisation": 0.15,
+            "FreeExtents": 3,
+            "LargestFreeExtents": [{"Start": 111, "End": 119, "Length": 9}, {"Start": 104, "End": 109, "Length": 6}],
+            "Fragmentation": round(1 - 9 / 17, 4),
+            "HeadroomDays": 4.2,
+        }
+
+    def test_fragmentation_ignores_top(self, mock_elbv2_client):
+        """Test that listing no extents still measures fragmentation against the largest one."""
+        mock_elbv2_client.describe_rules.return_value = {"Rules": [{"Priority": "110"}]}
+
+        report = index.analyze_listener("test-listener-arn", (100, 119), top=0)
+
+        assert report["LargestFreeExtents"] == []
+        assert report["Fragmentation"] == round(1 - 10 / 19, 4)
+
+    def test_negative_top_rejected(self, mock_context, mock_elbv2_client):
+        """Test that a negative Top fails the request instead of trimming extents from the end."""
+        with pytest.raises(ValueError, match="Top must not be negative"):
+            index.handler({"Action": "AnalyzeListeners", "ListenerArn": "listener-a", "Top": "-1"}, mock_context)
+        mock_elbv2_client.describe_rules.assert_not_called()
+
+    def test_analysis_reads_fresh_rules(self, mock_elbv2_client):
+        """Test that analytics ignore a warm snapshot and read the listener again."""
+        index.get_rule_snapshot("test-listener-arn")
+
+        index.analyze_listener("test-listener-arn")
+
+        assert mock_elbv2_client.describe_rules.call_count == 2
+
+    def test_handler_action(self, mock_context, mock_elbv2_client, capsys):
+        """Test that a direct AnalyzeListeners invocation reports every listener, including ones that fail."""
+        def describe_rules(**kwargs):
+            if kwargs["ListenerArn"] == "missing":
+                raise ClientError({"Error": {"Code": "ListenerNotFound", "Message": "Not found"}}, "DescribeRules")
+            return {"Rules": []}
+
+        mock_elbv2_client.describe_rules.side_effect = describe_rules
+
+        result = index.handler({"Action": "AnalyzeListeners", "ListenerArns": ["listener-a", "missing"], "PriorityRange": "20000-20999"}, mock_context)
+
+        assert result["Listeners"]["listener-a"]["Free"] == 1000
+        assert result["Listeners"]["listener-a"]["Fragmentation"] == 0
+        assert result["Listeners"]["listener-a"]["HeadroomDays"] is None
+        assert "ListenerNotFound" in result["Listeners"]["missing"]["Error"]
+        assert json.loads(capsys.readouterr().out.strip().splitlines()[-1])["RequestType"] == "AnalyzeListeners"
+
+
+class TestFleetPlanner:
+    """Tests for the offline fleet planner."""
+
+    LISTENER_A = "arn:aws:elasticloadbalancing:eu-west-1:123456789012:listener/app/web/50dc6c495c0c9188/f2f7dc8efc522ab2"
+    LISTENER_B = "arn:aws:elasticloadbalancing:eu-west-1:123456789012:listener/app/web/50dc6c495c0c9188/0467ef3c8400ae65"
+
+    def export(self, listener_arn, priorities):
+        rule_arn = listener_arn.replace(":listener/", ":listener-rule/")
+        rules = [{"RuleArn": f"{rule_arn}/default", "Priority": "default"}]
+        rules += [{"RuleArn": f"{rule_arn}/{uuid.uuid4().hex[:16]}", "Priority": str(p)} for p in priorities]
+        return {"Rules": rules}
+
+    def test_listener_arn_from_rule_arn(self):
+        """Test that a rule ARN maps back to its listener."""
+        rule_arn = self.LISTENER_A.replace(":listener/", ":listener-rule/") + "/9683b2d02a6cabee"
+        assert index.listener_arn_from_rule_arn(rule_arn) == self.LISTENER_A
+        with pytest.raises(ValueError):
+            index.listener_arn_from_rule_arn(self.LISTENER_A)
+
+    def test_rule_exports_grouped_by_listener(self):
+        """Test that rules from several exports are grouped by listener."""
+        occupancies = index.load_rule_exports([self.export(self.LISTENER_A, [10000]), self.export(self.LISTENER_B, [10001]), self.export(self.LISTENER_A, [10002])])
+
+        assert set(occupancies) == {self.LISTENER_A, self.LISTENER_B}
+        assert [p for p in range(10000, 10003) if occupancies[self.LISTENER_A][p]] == [10000, 10002]
+        assert [p for p in range(10000, 10003) if occupancies[self.LISTENER_B][p]] == [10001]
+
+    def test_plan_is_collision_free(self):
+        """Test that the plan avoids existing rules and never hands out a priority twice."""
+        occupancies = index.load_rule_exports([self.export(self.LISTENER_A, range(20000, 20090)), self.export(self.LISTENER_B, [])])
+        manifest = [{"StackName": f"service-{i}", "ListenerArn": self.LISTENER_A, "PriorityCount": "2", "PriorityRange": "20000-20099"} for i in range(2)]
+        manifest += [
+            {"StackName": "blocks", "ListenerArn": self.LISTENER_A, "PriorityCount": "4", "Contiguous": "true", "PriorityRange": "20000-20099"},
+            {"StackName": "both", "ListenerArns": [self.LISTENER_A, self.LISTENER_B], "PriorityRange": "20000-20099"},
+        ]
+
+        plan = index.plan_priorities(occupancies, manifest)
+
+        listener_a = [int(p) for priority_sets in plan for p in priority_sets[0]]
+        assert len(listener_a) == len(set(listener_a)) == 9
+        assert all(20090 <= p <= 20099 for p in listener_a)
+        assert plan[2] == [["20090", "20091", "20092", "20093"]]
+        assert len(plan[3]) == 2 and len(plan[3][1]) == 1
+
+    def test_plan_fails_when_range_is_full(self):
+        """Test that a manifest needing more than the range holds fails."""
+        occupancies = index.load_rule_exports([self.export(self.LISTENER_A, [])])
+        manifest = [{"StackName": "big", "ListenerArn": self.LISTENER_A, "PriorityCount": "11", "PriorityRange": "20000-20009"}]
+
+        with pytest.raises(index.PriorityRangeExhaustedError):
+            index.plan_priorities(occupancies, manifest)
+
+    def test_plan_requires_export_for_listener(self):
+        """Test that a listener without an export is reported instead of planned blind."""
+        with pytest.raises(ValueError, match="No describe-rules export"):
+            index.plan_priorities({}, [{"StackName": "orphan", "ListenerArn": self.LISTENER_A}])
+
+    def test_main_prints_parameters(self, tmp_path, capsys):
+        """Test the command line end to end with CloudFormation parameter output."""
+        rules = tmp_path / "rules.json"
+        rules.write_text(json.dumps(self.export(self.LISTENER_A, range(20000, 20008))))
+        manifest = tmp_path / "manifest.json"
+        manifest.write_text(json.dumps([
+            {"StackName": "orders", "LogicalResourceId": "Api", "ListenerArn": self.LISTENER_A, "PriorityCount": "2", "PriorityRange": "20000-20009"},
+        ]))
+
+        index.main(["--rules", str(rules), "--manifest", str(manifest), "--format", "parameters"])
+
+        assert json.loads(capsys.readouterr().out) == {"orders": [{"ParameterKey": "ApiPriorities", "ParameterValue": "20008,20009"}]}
 
 
 class TestSendResponse:
@@ -262,7 +1484,7 @@ class TestSendResponse:
         assert body["PhysicalResourceId"] == physical_id
         assert body["Data"] == response_data
 
-    def test_http_error_handling(self, create_event, mock_context):
+    def test_http_error_handling(self, create_event, mock_context, caplog):
         """Test handling of HTTP errors when sending the response."""
         # Mock HTTPSConnection to simulate an error
         with patch("http.client.HTTPSConnection") as mock_https:
@@ -275,12 +1497,192 @@ class TestSendResponse:
             mock_response.read.return_value = b"Internal Server Error"
             mock_conn.getresponse.return_value = mock_response
             
-            # Mock print to capture the error message
-            with patch("builtins.print") as mock_print:
+            with patch("time.sleep"):
                 physical_id = str(uuid.uuid4())
                 response_data = {"Priority": "12345"}
                 
                 index.send(create_event, mock_context, index.SUCCESS, response_data, physical_id)
                 
                 # Verify error was logged
-                mock_print.assert_any_call("Failed to send message to CloudFormation. HTTP status code: 500")
+                assert "Failed to send message to CloudFormation. HTTP status code: 500" in caplog.messages
+
+
+class TestSendDelivery:
+    """Tests for send() against a local stand-in for the response URL."""
+
+    def test_delivers_response(self, create_event, mock_context, cfn_response_server):
+        """Test that the response is PUT to the path and query of the ResponseURL."""
+        create_event["ResponseURL"] = cfn_response_server.url
+
+        status = index.send(create_event, mock_context, index.SUCCESS, {"Priority": "12345"}, "physical-id")
+
+        assert status == 200
+        assert len(cfn_response_server.requests) == 1
+        request = cfn_response_server.requests[0]
+        assert request["path"] == "/response?X-Amz-Signature=test"
+        assert request["body"]["Data"] == {"Priority": "12345"}
+
+    def test_retries_server_errors(self, create_event, mock_context, cfn_response_server):
+        """Test that 5xx and 429 responses are retried with backoff until one succeeds."""
+        create_event["ResponseURL"] = cfn_response_server.url
+        cfn_response_server.statuses = [503, 429]
+
+        with patch("time.sleep") as mock_sleep:
+            status = index.send(create_event, mock_context, index.SUCCESS, {}, "physical-id")
+
+        assert status == 200
+        assert len(cfn_response_server.requests) == 3
+        assert mock_sleep.call_count == 2
+        assert 0 <= mock_sleep.call_args_list[1][0][0] <= index.SEND_BACKOFF_BASE * 2
+
+    def test_client_errors_not_retried(self, create_event, mock_context, cfn_response_server):
+        """Test that a 4xx response such as an expired URL is not retried."""
+        create_event["ResponseURL"] = cfn_response_server.url
+        cfn_response_server.statuses = [403]
+
+        with patch("time.sleep") as mock_sleep:
+            status = index.send(create_event, mock_context, index.SUCCESS, {}, "physical-id")
+
+        assert status == 403
+        assert len(cfn_response_server.requests) == 1
+        mock_sleep.assert_not_called()
+
+    def test_retries_bounded_by_remaining_time(self, create_event, mock_context, cfn_response_server):
+        """Test that no retry is made when it would not fit in the remaining invocation time."""
+        create_event["ResponseURL"] = cfn_response_server.url
+        cfn_response_server.statuses = [500, 500]
+        mock_context.get_remaining_time_in_millis.return_value = 1000
+
+        with patch("time.sleep") as mock_sleep:
+            status = index.send(create_event, mock_context, index.SUCCESS, {}, "physical-id")
+
+        assert status == 500
+        assert len(cfn_response_server.requests) == 1
+        mock_sleep.assert_not_called()
+
+    def test_connection_reused(self, create_event, mock_context, cfn_response_server):
+        """Test that consecutive responses share one keep-alive connection."""
+        create_event["ResponseURL"] = cfn_response_server.url
+
+        index.send(create_event, mock_context, index.SUCCESS, {}, "physical-id")
+        index.send(create_event, mock_context, index.SUCCESS, {}, "physical-id")
+
+        clients = {request["client"] for request in cfn_response_server.requests}
+        assert len(cfn_response_server.requests) == 2
+        assert len(clients) == 1
+
+    def test_reconnects_after_connection_error(self, create_event, mock_context):
+        """Test that a dropped connection is replaced before the next attempt."""
+        create_event["ResponseURL"] = "https://example.com/response?sig=1"
+        broken, healthy = MagicMock(), MagicMock()
+        broken.request.side_effect = ConnectionResetError("reset")
+        healthy.getresponse.return_value.status = 200
+
+        with patch("http.client.HTTPSConnection", side_effect=[broken, healthy]) as mock_https, patch("time.sleep"):
+            status = index.send(create_event, mock_context, index.SUCCESS, {}, "physical-id")
+
+        assert status == 200
+        assert mock_https.call_count == 2
+        mock_https.assert_called_with("example.com", timeout=index.SEND_CONNECT_TIMEOUT)
+        broken.close.assert_called_once()
+
+
+class TestBatchRecords:
+    """Tests for SNS and SQS batch mode."""
+
+    def sqs_record(self, event, message_id):
+        return {"messageId": message_id, "eventSource": "aws:sqs", "body": json.dumps(event)}
+
+    def event(self, create_event, url, logical_id, listener_arn):
+        return {**create_event, "ResponseURL": url, "LogicalResourceId": logical_id, "RequestId": logical_id,
+                "ResourceProperties": {**create_event["ResourceProperties"], "ListenerArn": listener_arn}}
+
+    def test_parse_record(self, create_event):
+        """Test that SNS, raw SQS and SNS-through-SQS records all yield the event."""
+        message = json.dumps(create_event)
+
+        assert index.parse_record({"Sns": {"Message": message}}) == create_event
+        assert index.parse_record({"body": message}) == create_event
+        assert index.parse_record({"body": json.dumps({"Type": "Notification", "Message": message})}) == create_event
+
+    def test_one_describe_per_listener(self, create_event, mock_context, mock_elbv2_client, cfn_response_server):
+        """Test that a batch reads each listener once and answers every record."""
+        records = [
+            self.sqs_record(self.event(create_event, cfn_response_server.url, f"Rule{i}", listener), f"message-{i}")
+            for i, listener in enumerate(["listener-a", "listener-a", "listener-b"])
+        ]
+
+        result = index.handler({"Records": records}, mock_context)
+
+        assert result == {"batchItemFailures": []}
+        assert sorted(c.kwargs["ListenerArn"] for c in mock_elbv2_client.describe_rules.call_args_list) == ["listener-a", "listener-b"]
+        bodies = {request["body"]["LogicalResourceId"]: request["body"] for request in cfn_response_server.requests}
+        assert sorted(bodies) == ["Rule0", "Rule1", "Rule2"]
+        assert all(body["Status"] == "SUCCESS" for body in bodies.values())
+        assert bodies["Rule0"]["Data"]["Priority"] != bodies["Rule1"]["Data"]["Priority"]
+
+    def test_failed_event_reported_to_cloudformation(self, create_event, mock_context, mock_elbv2_client, cfn_response_server):
+        """Test that an event that fails is answered FAILED without failing the record."""
+        event = self.event(create_event, cfn_response_server.url, "Rule0", "listener-a")
+        event["ResourceProperties"]["PriorityRange"] = "not-a-range"
+
+        result = index.handler({"Records": [self.sqs_record(event, "message-0")]}, mock_context)
+
+        assert result == {"batchItemFailures": []}
+        assert cfn_response_server.requests[0]["body"]["Status"] == "FAILED"
+
+    def test_undelivered_and_unreadable_records_retried(self, create_event, mock_context, mock_elbv2_client, cfn_response_server):
+        """Test that only records that were unreadable or whose response was not delivered are reported."""
+        cfn_response_server.statuses = [500] * index.SEND_MAX_ATTEMPTS
+        records = [
+            self.sqs_record(self.event(create_event, cfn_response_server.url, "Rule0", "listener-a"), "message-0"),
+            {"messageId": "message-1", "body": "not json"},
+        ]
+
+        with patch("time.sleep"):
+            result = index.handler({"Records": records}, mock_context)
+
+        assert result == {"batchItemFailures": [{"itemIdentifier": "message-1"}, {"itemIdentifier": "message-0"}]}
+
+
+class TestMetrics:
+    """Tests for CloudWatch Embedded Metric Format output."""
+
+    def test_flush_writes_emf_document(self, capsys):
+        """Test that recorded metrics are written as one EMF line and then cleared."""
+        index.put_metric("DescribeRulesCalls", 1)
+        index.put_metric("DescribeRulesCalls", 1)
+        with patch("time.monotonic", side_effect=[1.0, 1.25]):
+            with index.timed("AllocationTime"):
+                pass
+
+        index.flush_metrics({"RequestType": "Create"})
+
+        document = json.loads(capsys.readouterr().out)
+        metadata = document["_aws"]["CloudWatchMetrics"][0]
+        assert metadata["Namespace"] == index.METRICS_NAMESPACE
+        assert metadata["Dimensions"] == [["RequestType"]]
+        assert {"Name": "AllocationTime", "Unit": "Milliseconds"} in metadata["Metrics"]
+        assert document["RequestType"] == "Create"
+        assert document["DescribeRulesCalls"] == [1, 1]
+        assert document["AllocationTime"] == 250.0
+
+        index.flush_metrics({"RequestType": "Create"})
+        assert capsys.readouterr().out == ""
+
+    def test_handler_emits_allocation_metrics(self, create_event_with_count, mock_context, mock_elbv2_client, mock_http_client, capsys):
+        """Test that a Create invocation reports describe_rules, allocation and send metrics."""
+        index.handler(create_event_with_count, mock_context)
+
+        document = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+        for name in ("DescribeRulesTime", "DescribeRulesCalls", "AllocationTime", "RangeUtilisation", "PrioritiesAllocated", "SendTime"):
+            assert name in document
+        assert document["PrioritiesAllocated"] == 2
+
+    def test_metrics_disabled(self, capsys):
+        """Test that nothing is written when metrics are disabled."""
+        index.put_metric("DescribeRulesCalls", 1)
+        with patch.object(index, "METRICS_ENABLED", False):
+            index.flush_metrics({"RequestType": "Create"})
+
+        assert capsys.readouterr().out == ""